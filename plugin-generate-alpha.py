@@ -1,9 +1,330 @@
 from traceback import format_exc
-from gimpfu import *
-import gtk
+import collections
+import csv
+import multiprocessing
+import os
+import re
+import sys
+
+# Batches can also be run outside GIMP, reading and writing files with PIL
+try:
+  from gimpfu import *
+  import gtk
+except ImportError:
+  gimp = None
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# Screenshot file names of a pair, <name>-white and <name>-black
+PAIR_PATTERN = re.compile(r'^(.*?)[-_. ](white|black)\.(png|jpe?g|bmp|tiff?)$', re.IGNORECASE)
+
+# Width of the strips around the edges of the screenshots sampled for the
+# background colours
+EDGE_SAMPLES = 4
+# Rows of the screenshots computed at once
+TILE_ROWS = 256
+# Pairs loaded by GIMP and waiting for or in a worker process at once
+BATCH_PAIRS = 4
+
+# Channel types of each image precision, ignoring whether it is linear or gamma
+PRECISION_TYPES = {100: 'uint8', 200: 'uint16', 300: 'uint32', 500: 'float16', 600: 'float32', 700: 'float64'}
+
+# Channel type of a pixel region with the given number of channels and the
+# scale of its values to 0-1. Plug-ins are given 8-bit pixels unless GIMP
+# delivers the image precision, which is only used when the bytes per pixel
+# match it.
+def pixel_format(image, pr, channels):
+  dtype = numpy.dtype(PRECISION_TYPES.get(pdb.gimp_image_get_precision(image) // 100 * 100, 'uint8'))
+  if pr.bpp != channels * dtype.itemsize:
+    dtype = numpy.dtype(numpy.uint8)
+  if dtype.kind == 'f':
+    return dtype, 1.0
+  return dtype, 1.0 / numpy.iinfo(dtype).max
+
+# Colour and alpha of an object from screenshots of it over a white and a black
+# background. white and black are the colour channels scaled to 0-1. Returns
+# the un-premultiplied RGBA scaled to 0-1.
+def compute_alpha(white, black, bg_white=1.0, bg_black=0.0):
+  # The backgrounds show through by 1 - alpha, so that is how much of their
+  # difference remains
+  spread = numpy.maximum(numpy.asarray(bg_white, float) - bg_black, 1e-6)
+  alpha = numpy.clip(1.0 - ((white - black) / spread).mean(-1), 0.0, 1.0)[..., None]
+
+  # Remove each background from its screenshot and average the two colours
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    colour = (white + black - (1.0 - alpha) * (bg_white + numpy.asarray(bg_black, float))) / (2.0 * alpha)
+  colour = numpy.where(alpha > 0.0, numpy.clip(colour, 0.0, 1.0), 0.0)
+  return numpy.concatenate((colour, alpha), -1)
+
+# Rects of the strips around the edges of an area, n pixels wide
+def edge_rects(w, h, n):
+  if w <= 2*n or h <= 2*n: return [(0, 0, w, h)]
+  return [(0, 0, w, n), (0, h - n, w, n), (0, n, n, h - 2*n), (w - n, n, n, h - 2*n)]
+
+# Background colours of the white and black screenshots, from the median of
+# the samples that differ most between them (where the object is transparent).
+# Falls back to pure white and black when the backgrounds barely differ.
+def estimate_background(white, black):
+  white = numpy.concatenate([c.reshape(-1, 3) for c in white])
+  black = numpy.concatenate([c.reshape(-1, 3) for c in black])
+  diff = (white - black).sum(-1)
+  background = diff >= 0.9 * diff.max()
+  bg_white = numpy.median(white[background], 0)
+  bg_black = numpy.median(black[background], 0)
+  if (bg_white - bg_black).min() < 0.5:
+    return 1.0, 0.0
+  return bg_white, bg_black
+
+# Whether a pair of screenshots is the wrong way round, from samples of their
+# edges. The white screenshot is brighter where the object is transparent.
+def is_swapped(white, black):
+  return sum((w - b).sum() for w, b in zip(white, black)) < 0
+
+# Colour channels of part of a drawable scaled to 0-1. x and y are relative to
+# the drawable.
+def read_colour(drawable, x, y, w, h, fmt):
+  dtype, scale = fmt
+  pr = drawable.get_pixel_rgn(x, y, w, h)
+  pixels = numpy.frombuffer(pr[x:x+w, y:y+h], dtype).reshape(h, w, -1)
+  return pixels[..., :3] * scale
+
+# Values scaled to 0-1 in the channel type of the image
+def to_pixels(values, fmt):
+  dtype, scale = fmt
+  if dtype.kind == 'f':
+    return values.astype(dtype)
+  return numpy.trunc(values / scale + 0.5).astype(dtype)
+
+# Computes the alpha and colour of each pixel in one pass and writes a single
+# layer covering the overlap of the two layers. Rows are processed TILE_ROWS at
+# a time, so memory use does not depend on the height of the layers.
+# With estimate, the background colours are sampled from the edges of the
+# layers instead of assuming pure white and black.
+# The white and black screenshots may be either way round, and are told apart
+# by the edges of the layers.
+def generate_alpha_numpy(image, parent, position, drawable, drawable2, estimate=1):
+  x = max(drawable.offsets[0], drawable2.offsets[0])
+  y = max(drawable.offsets[1], drawable2.offsets[1])
+  w = min(drawable.offsets[0] + drawable.width, drawable2.offsets[0] + drawable2.width) - x
+  h = min(drawable.offsets[1] + drawable.height, drawable2.offsets[1] + drawable2.height) - y
+  if w <= 0 or h <= 0: return
+
+  layer = gimp.Layer(image, drawable.name, w, h, RGBA_IMAGE, 100, LAYER_MODE_NORMAL)
+  layer.set_offsets(x, y)
+  pr = layer.get_pixel_rgn(0, 0, w, h, True)
+  fmt = pixel_format(image, pr, 4)
+
+  pdb.gimp_progress_set_text("Generate Alpha: Sample edges")
+  rects = edge_rects(w, h, EDGE_SAMPLES)
+  edges = [[read_colour(d, x - d.offsets[0] + rx, y - d.offsets[1] + ry, rw, rh, fmt) for rx, ry, rw, rh in rects]
+    for d in (drawable, drawable2)]
+  white, black = drawable, drawable2
+  if is_swapped(*edges):
+    white, black = black, white
+    edges.reverse()
+  bg_white, bg_black = 1.0, 0.0
+  if estimate:
+    bg_white, bg_black = estimate_background(*edges)
+  x1, y1 = white.offsets
+  x2, y2 = black.offsets
+
+  pdb.gimp_progress_set_text("Generate Alpha: Process rows")
+  for ty in xrange(0, h, TILE_ROWS):
+    th = min(TILE_ROWS, h - ty)
+    white_rows = read_colour(white, x - x1, y - y1 + ty, w, th, fmt)
+    black_rows = read_colour(black, x - x2, y - y2 + ty, w, th, fmt)
+    pr[0:w, ty:ty + th] = to_pixels(compute_alpha(white_rows, black_rows, bg_white, bg_black), fmt).tobytes()
+    gimp.progress_update(1.0 * (ty + th) / h)
+  pdb.gimp_image_insert_layer(image, layer, parent, position)
+
+  pdb.gimp_image_remove_layer(image, drawable)
+  pdb.gimp_image_remove_layer(image, drawable2)
+
+# Pairs of white and black screenshots to process, as (white, black, output).
+# A manifest lists "white, black[, output]" on each line, relative to its own
+# directory. Otherwise the directory is searched for <name>-white and
+# <name>-black files. Results are written to <output>/<name>.png by default.
+def find_pairs(source, output):
+  pairs = []
+  if os.path.isfile(source):
+    directory = os.path.dirname(source)
+    with open(source) as f:
+      for row in csv.reader(f):
+        row = [path.strip() for path in row if path.strip()]
+        if len(row) < 2 or row[0].startswith('#'): continue
+        white, black = [os.path.join(directory, path) for path in row[:2]]
+        if len(row) > 2:
+          target = os.path.join(output, row[2])
+        else:
+          match = PAIR_PATTERN.match(os.path.basename(white))
+          name = match.group(1) if match else os.path.splitext(os.path.basename(white))[0]
+          target = os.path.join(output, name + '.png')
+        pairs.append((white, black, target))
+  else:
+    found = {}
+    for filename in sorted(os.listdir(source)):
+      match = PAIR_PATTERN.match(filename)
+      if match is None: continue
+      found.setdefault(match.group(1), {})[match.group(2).lower()] = os.path.join(source, filename)
+    for name in sorted(found):
+      if len(found[name]) < 2: continue
+      pairs.append((found[name]['white'], found[name]['black'], os.path.join(output, name + '.png')))
+  return pairs
+
+# Result of a pair as 8-bit RGBA, over the area both screenshots cover, with
+# the background colours sampled from their edges
+def alpha_pixels(white, black):
+  h = min(white.shape[0], black.shape[0])
+  w = min(white.shape[1], black.shape[1])
+  white = white[:h, :w]
+  black = black[:h, :w]
+  rects = edge_rects(w, h, EDGE_SAMPLES)
+  bg_white, bg_black = estimate_background(
+    [white[ry:ry + rh, rx:rx + rw] for rx, ry, rw, rh in rects],
+    [black[ry:ry + rh, rx:rx + rw] for rx, ry, rw, rh in rects])
+  return to_pixels(compute_alpha(white, black, bg_white, bg_black), (numpy.dtype(numpy.uint8), 1.0 / 255))
+
+# Worker for a pair loaded by GIMP, as channel values and their scale to 0-1
+def alpha_task(args):
+  (white, white_scale), (black, black_scale), target = args
+  return alpha_pixels(white * white_scale, black * black_scale), target
+
+# Worker for a pair outside GIMP, loading and saving the files with PIL
+def alpha_file_task(args):
+  from PIL import Image
+  white, black, target = args
+  try:
+    white = numpy.asarray(Image.open(white).convert('RGB')) / 255.0
+    black = numpy.asarray(Image.open(black).convert('RGB')) / 255.0
+    Image.fromarray(alpha_pixels(white, black), 'RGBA').save(target)
+    return None
+  except Exception:
+    return '%s: %s' % (target, format_exc().splitlines()[-1])
+
+# Load a screenshot with GIMP as its colour channels, unscaled so that they
+# are no larger than GIMP gives them, and their scale to 0-1
+def load_pixels(path):
+  image = pdb.gimp_file_load(path, path)
+  try:
+    layer = pdb.gimp_image_flatten(image)
+    w, h = layer.width, layer.height
+    pr = layer.get_pixel_rgn(0, 0, w, h)
+    dtype, scale = pixel_format(image, pr, 4 if layer.has_alpha else 3)
+    pixels = numpy.frombuffer(pr[0:w, 0:h], dtype).reshape(h, w, -1)
+    return numpy.ascontiguousarray(pixels[..., :3]), scale
+  finally:
+    pdb.gimp_image_delete(image)
+
+# Save 8-bit RGBA pixels as a PNG with GIMP
+def save_pixels(pixels, path):
+  h, w = pixels.shape[:2]
+  image = gimp.Image(w, h, RGB)
+  try:
+    layer = gimp.Layer(image, os.path.basename(path), w, h, RGBA_IMAGE, 100, LAYER_MODE_NORMAL)
+    pr = layer.get_pixel_rgn(0, 0, w, h, True)
+    pr[0:w, 0:h] = pixels.tobytes()
+    pdb.gimp_image_insert_layer(image, layer, None, 0)
+    pdb.file_png_save_defaults(image, layer, path, path)
+  finally:
+    pdb.gimp_image_delete(image)
+
+# Generate alpha for each pair of screenshots in a directory or manifest,
+# writing PNGs to output. Pairs are computed by a pool of worker processes.
+# In GIMP only the main process can load and save files, so at most BATCH_PAIRS
+# pairs are loaded at once, whatever the number of processes. Returns the pairs
+# that failed.
+def generate_alpha_batch(source, output, processes=2):
+  processes = max(int(processes), 1)
+  output = output or os.path.join(source if os.path.isdir(source) else os.path.dirname(source), 'alpha')
+  if not os.path.isdir(output):
+    os.makedirs(output)
+  pairs = find_pairs(source, output)
+  failed = []
+
+  if gimp is not None:
+    processes = min(processes, BATCH_PAIRS)
+  pool = multiprocessing.Pool(processes)
+  try:
+    if gimp is None:
+      for error in pool.imap_unordered(alpha_file_task, pairs):
+        if error is not None: failed.append(error)
+    else:
+      gimp.progress_init("Generate Alpha: Batch")
+      pending = collections.deque()
+      done = 0
+      for pair in pairs + [None]*BATCH_PAIRS:
+        if pair is not None:
+          white, black, target = pair
+          try:
+            pending.append((target, pool.apply_async(alpha_task, ((load_pixels(white), load_pixels(black), target),))))
+          except Exception:
+            failed.append('%s: %s' % (target, format_exc().splitlines()[-1]))
+        # Save the oldest result once enough pairs are in flight, then the rest
+        if pending and (len(pending) >= BATCH_PAIRS or pair is None):
+          target, result = pending.popleft()
+          try:
+            save_pixels(*result.get())
+          except Exception:
+            failed.append('%s: %s' % (target, format_exc().splitlines()[-1]))
+          done += 1
+          gimp.progress_update(1.0 * done / max(len(pairs), 1))
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+  return failed
+
+def batch_main(directory, manifest, output, processes=2):
+  try:
+    if numpy is None:
+      pdb.gimp_message("Generate Alpha: Batches need numpy")
+      return
+    failed = generate_alpha_batch(manifest or directory, output, processes)
+    if failed:
+      pdb.gimp_message("Generate Alpha: Failed pairs:\n" + "\n".join(failed))
+  except:
+    pdb.gimp_message(format_exc())
+
+# Builds the alpha with layer modes and a mask on a layer group. Used when
+# numpy is not installed.
+def generate_alpha_layers(image, parent, position, drawable, drawable2):
+  group = pdb.gimp_layer_group_new(image)
+  group.mode = LAYER_MODE_NORMAL_LEGACY
+  pdb.gimp_image_insert_layer(image, group, parent, position)
+
+  # Add working layers to the image
+  mask1 = pdb.gimp_layer_new_from_drawable(drawable, image)
+  mask2 = pdb.gimp_layer_new_from_drawable(drawable2, image)
+  layer1 = pdb.gimp_layer_new_from_drawable(drawable, image)
+  layer2 = pdb.gimp_layer_new_from_drawable(drawable2, image)
+  for layer in (layer2, layer1, mask2, mask1):
+    layer.visible = True
+    layer.mode = LAYER_MODE_NORMAL_LEGACY
+    pdb.gimp_image_insert_layer(image, layer, group, position)
+
+  # Convert mask layers to an alpha channel
+  pdb.gimp_layer_set_mode(mask1, LAYER_MODE_DIFFERENCE_LEGACY)
+  layer = pdb.gimp_image_merge_down(image, mask1, CLIP_TO_BOTTOM_LAYER)
+  pdb.gimp_drawable_invert(layer, True)
+  pdb.gimp_drawable_desaturate(layer, DESATURATE_VALUE)
+  pdb.gimp_drawable_levels_stretch(layer)
+
+  # Apply to the group as a mask
+  mask = pdb.gimp_layer_create_mask(group, ADD_MASK_COPY)
+  pdb.gimp_layer_add_mask(group, mask)
+
+  # Adjust the brightness of semi-transparent areas
+  layer1.opacity = 30.0
+  
+  pdb.gimp_image_remove_layer(image, layer)
+  pdb.gimp_image_remove_layer(image, drawable)
+  pdb.gimp_image_remove_layer(image, drawable2)
 
 # Main function
-def plugin_main(image, drawable):
+def plugin_main(image, drawable, estimate=1):
   try:
     # Get all linked layers within the specified image or layer group
     parent = pdb.gimp_item_get_parent(drawable)
@@ -20,44 +341,29 @@ def plugin_main(image, drawable):
       return
 
     pdb.gimp_image_undo_group_start(image)
-    
-    group = pdb.gimp_layer_group_new(image)
-    group.mode = LAYER_MODE_NORMAL_LEGACY
-    pdb.gimp_image_insert_layer(image, group, parent, position)
-
-    # Add working layers to the image
-    mask1 = pdb.gimp_layer_new_from_drawable(drawable, image)
-    mask2 = pdb.gimp_layer_new_from_drawable(drawable2, image)
-    layer1 = pdb.gimp_layer_new_from_drawable(drawable, image)
-    layer2 = pdb.gimp_layer_new_from_drawable(drawable2, image)
-    for layer in (layer2, layer1, mask2, mask1):
-      layer.visible = True
-      layer.mode = LAYER_MODE_NORMAL_LEGACY
-      pdb.gimp_image_insert_layer(image, layer, group, position)
-
-    # Convert mask layers to an alpha channel
-    pdb.gimp_layer_set_mode(mask1, LAYER_MODE_DIFFERENCE_LEGACY)
-    layer = pdb.gimp_image_merge_down(image, mask1, CLIP_TO_BOTTOM_LAYER)
-    pdb.gimp_drawable_invert(layer, True)
-    pdb.gimp_drawable_desaturate(layer, DESATURATE_VALUE)
-    pdb.gimp_drawable_levels_stretch(layer)
-
-    # Apply to the group as a mask
-    mask = pdb.gimp_layer_create_mask(group, ADD_MASK_COPY)
-    pdb.gimp_layer_add_mask(group, mask)
-
-    # Adjust the brightness of semi-transparent areas
-    layer1.opacity = 30.0
-    
-    pdb.gimp_image_remove_layer(image, layer)
-    pdb.gimp_image_remove_layer(image, drawable)
-    pdb.gimp_image_remove_layer(image, drawable2)
-      
+    # Fall back to layer operations when numpy is not installed
+    if numpy is not None:
+      gimp.progress_init("Generate Alpha")
+      generate_alpha_numpy(image, parent, position, drawable, drawable2, estimate)
+    else:
+      generate_alpha_layers(image, parent, position, drawable, drawable2)
     pdb.gimp_image_undo_group_end(image)
   except:
     pdb.gimp_message(format_exc())
 
-if __name__ == "__main__": # invoked at top level, from GIMP
+if __name__ == "__main__" and gimp is None: # invoked as a script
+  if len(sys.argv) < 2:
+    sys.exit("Usage: %s DIRECTORY|MANIFEST [OUTPUT] [PROCESSES]" % sys.argv[0])
+  try:
+    import numpy, PIL
+  except ImportError:
+    sys.exit("Generate Alpha: Batches outside GIMP need numpy and PIL")
+  failed = generate_alpha_batch(sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else '', sys.argv[3] if len(sys.argv) > 3 else multiprocessing.cpu_count())
+  for error in failed:
+    sys.stderr.write(error + '\n')
+  sys.exit(1 if failed else 0)
+
+elif __name__ == "__main__": # invoked at top level, from GIMP
   gettext.install("gimp20-python", gimp.locale_directory, unicode=True)
   register(
     "python_fu_generate_alpha",  # <= procedure name
@@ -68,10 +374,33 @@ if __name__ == "__main__": # invoked at top level, from GIMP
     "2023/07/04",
     "Generate Alpha",  # <= menu item
     "RGB*", # <= image type
-    [(PF_IMAGE, "image", "Input image", None), (PF_DRAWABLE, "drawable", "Input drawable", None)], # <= hidden and deferred parameters
+    [
+      (PF_IMAGE, "image", "Input image", None),
+      (PF_DRAWABLE, "drawable", "Input drawable", None),
+      (PF_TOGGLE, "estimate", "Estimate background colours", 1)
+    ],
     [],
     plugin_main,
     menu="<Image>/Colors", # <= menu path
     domain=("gimp20-python", gimp.locale_directory))
+  register(
+    "python_fu_generate_alpha_batch",
+    "Generates alpha for each pair of white and black screenshots in a directory or manifest, saving them as PNGs.",
+    "Pairs are files named <name>-white and <name>-black, or listed as \"white, black[, output]\" on each line of a manifest. Can be run with gimp -i -b.",
+    "Gavin Ward",
+    "Gavin Ward",
+    "2023/07/04",
+    "Generate Alpha (batch)...",
+    "",
+    [
+      (PF_DIRNAME, "directory", "Screenshots", ""),
+      (PF_FILE, "manifest", "Manifest (instead of the directory)", ""),
+      (PF_DIRNAME, "output", "Output", ""),
+      (PF_ADJUSTMENT, "processes", "Processes", 2, (1,64,1))
+    ],
+    [],
+    batch_main,
+    menu="<Image>/Colors",
+    domain=("gimp20-python", gimp.locale_directory))
   
   main()
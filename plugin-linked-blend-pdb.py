@@ -5,78 +5,128 @@ from gimpfu import *
 
 CROP = 0
 
-def get_linked_layers(image):
+# Linked layers of an image or group. With hide, every layer is hidden so
+# that only the blended layers are merged.
+def get_linked_layers(image, hide=1):
   layers = []
   for layer in image.layers:
-    if layer.visible: pdb.gimp_item_set_visible(layer, 0)
+    if hide and layer.visible: pdb.gimp_item_set_visible(layer, 0)
     if pdb.gimp_item_is_group(layer):
       continue
     if layer.linked:
       layers.append(layer)
   return layers
 
-def plugin_blend(image, drawable):
-  plugin_main(image, drawable, 1)
+def plugin_blend(image, drawable, crop_h=CROP, crop_v=CROP, scratch=0):
+  plugin_main(image, drawable, 1, crop_h=crop_h, crop_v=crop_v, scratch=scratch)
 
-def crop_by(image, layer, amount):
-  if amount <= 0: return
-  pdb.gimp_image_select_item(image, CHANNEL_OP_REPLACE, layer)
-  pdb.gimp_selection_shrink(image, amount)
-  x0, y0 = pdb.gimp_drawable_offsets(layer)
-  non_empty, x1, y1, x2, y2 = pdb.gimp_selection_bounds(image)
-  pdb.gimp_layer_resize(layer, x2-x1, y2-y1, x0-x1, y0-y1)
+# Shave pixels off each side of a layer, keeping at least one pixel
+def crop_by(layer, amount_h, amount_v):
+  if amount_h <= 0 and amount_v <= 0: return
+  width = max(layer.width - 2*max(amount_h, 0), 1)
+  height = max(layer.height - 2*max(amount_v, 0), 1)
+  pdb.gimp_layer_resize(layer, width, height, (width - layer.width) // 2, (height - layer.height) // 2)
 
-def plugin_main(image, drawable, copy=0, shuffle=1, alpharate=1.0):
+# Weight of each layer in the order they are blended. Each layer is blended
+# over the layers before it with an opacity of 1/alphafactor, where
+# alphafactor increases by alpharate for each layer, so an alpharate of 1
+# gives every layer the same weight.
+def get_weights(count, alpharate):
+  weights = [0.0]*count
+  remaining = 1.0
+  for i in reversed(xrange(count)):
+    alphafactor = 1.0 + i*alpharate
+    weights[i] = remaining/alphafactor
+    remaining *= 1.0 - 1.0/alphafactor
+  return weights
+
+# Blend layer b, directly below layer a, into a. Where only one layer has
+# pixels they are kept, elsewhere b is blended over a by its share of the
+# weights. Returns the merged layer.
+def merge_pair(image, parent, a, b, weight_a, weight_b):
+  pos = pdb.gimp_image_get_item_position(image, a)
+  layer_mode = pdb.gimp_layer_get_mode(b)
+
+  # Fill the transparent parts of a with b
+  layer1 = pdb.gimp_layer_copy(b, 1)
+  pdb.gimp_image_insert_layer(image, layer1, parent, pos + 1)
+  a = pdb.gimp_image_merge_down(image, a, 0)
+
+  total = weight_a + weight_b
+  pdb.gimp_image_reorder_item(image, b, parent, pos)
+  pdb.gimp_layer_set_opacity(b, 100.0*weight_b/total if total > 0.0 else 0.0)
+  new_layer = pdb.gimp_image_merge_down(image, b, 0)
+  pdb.gimp_layer_set_mode(new_layer, layer_mode)
+  return new_layer
+
+# With scratch, the linked layers are copied to a hidden image without undo
+# and blended there. Only the result is added to the image, and the
+# visibility of its layers is left unchanged.
+def plugin_main(image, drawable, copy=0, shuffle=1, alpharate=1.0, crop_h=CROP, crop_v=CROP, scratch=0):
+  work = None
   try:
     parent = pdb.gimp_item_get_parent(drawable)
-    layers = get_linked_layers(image if parent is None else parent)
+    layers = get_linked_layers(image if parent is None else parent, not scratch)
     if len(layers) < 2:
       return
     layer_name = layers[-1].name.partition('.')[0] + "-" + layers[0].name.partition('.')[0]
     pdb.gimp_image_undo_group_start(image)
 
-    alphafactor = 1.0
-    new_layer = pdb.gimp_layer_copy(layers[0], 1)
-    pdb.gimp_image_insert_layer(image, new_layer, parent, 0)
-    pdb.gimp_item_set_visible(new_layer, 1)
-    pdb.gimp_layer_set_opacity(new_layer, 100.0)
+    if scratch:
+      work = pdb.gimp_image_new_with_precision(image.width, image.height, pdb.gimp_image_base_type(image), pdb.gimp_image_get_precision(image))
+      pdb.gimp_image_undo_disable(work)
+      work_parent = None
+    else:
+      work = image
+      work_parent = parent
 
-    crop_by(image, new_layer, CROP)
-    
+    # Order to blend layers, alternating between the ends of the stack
+    order = [layers[0]]
     del(layers[0])
     i = 0
     while len(layers) > 0:
       if shuffle:
         i = -1 - i
-      layer = layers[i]
+      order.append(layers[i])
       del(layers[i])
-      
-      alphafactor += alpharate
-      layer1 = pdb.gimp_layer_copy(layer, 1)
-      pdb.gimp_layer_set_opacity(layer1, 100.0)
-      pdb.gimp_item_set_visible(layer1, 1)
-      pdb.gimp_image_insert_layer(image, layer1, parent, 1)
-      crop_by(image, layer1, CROP)
-      
-      new_layer = pdb.gimp_image_merge_down(image, new_layer, 0)
-      
 
-      if alphafactor <= 256.0:
+    # Copy each layer to the top of the stack in blend order
+    nodes = []
+    for layer, weight in zip(order, get_weights(len(order), alpharate)):
+      if scratch:
+        layer1 = pdb.gimp_layer_new_from_drawable(layer, work)
+      else:
         layer1 = pdb.gimp_layer_copy(layer, 1)
-        layer_mode = pdb.gimp_layer_get_mode(layer1)
-        pdb.gimp_layer_set_opacity(layer1, 100.0/alphafactor)
-        pdb.gimp_item_set_visible(layer1, 1)
-        pdb.gimp_image_insert_layer(image, layer1, parent, 0)
+      pdb.gimp_layer_set_opacity(layer1, 100.0)
+      pdb.gimp_item_set_visible(layer1, 1)
+      pdb.gimp_image_insert_layer(work, layer1, work_parent, len(nodes))
+      if scratch: pdb.gimp_layer_add_alpha(layer1)
+      crop_by(layer1, int(crop_h), int(crop_v))
+      nodes.append((layer1, weight))
 
-        crop_by(image, layer1, CROP)
+    # Merge neighbouring pairs, then pairs of pairs, until one layer is left.
+    # Each layer is merged log2(n) times at most.
+    while len(nodes) > 1:
+      merged = []
+      for i in xrange(0, len(nodes) - 1, 2):
+        (a, weight_a), (b, weight_b) = nodes[i:i + 2]
+        merged.append((merge_pair(work, work_parent, a, b, weight_a, weight_b), weight_a + weight_b))
+      if len(nodes) % 2:
+        merged.append(nodes[-1])
+      nodes = merged
 
-        new_layer = pdb.gimp_image_merge_down(image, layer1, 0)
-        pdb.gimp_layer_set_mode(new_layer, layer_mode)
+    new_layer = nodes[0][0]
+    if scratch:
+      # Copy the result back above the blended layers
+      new_layer = pdb.gimp_layer_new_from_drawable(new_layer, image)
+      pdb.gimp_image_insert_layer(image, new_layer, parent, 0)
     pdb.gimp_item_set_name(new_layer, layer_name)
     pdb.gimp_image_undo_group_end(image)
     
   except:
     pdb.gimp_message(format_exc())
+  finally:
+    if scratch and work is not None: pdb.gimp_image_delete(work)
 
 if __name__ == "__main__":
   
@@ -91,7 +141,13 @@ if __name__ == "__main__":
     "2017",
     "Blend linked (overlay)",
     "RGB*, GRAY*",
-    [(PF_IMAGE, "image", "Input image", None), (PF_DRAWABLE, "drawable", "Input drawable", None)],
+    [
+      (PF_IMAGE, "image", "Input image", None),
+      (PF_DRAWABLE, "drawable", "Input drawable", None),
+      (PF_ADJUSTMENT, "crop_h", "Crop H", CROP, (0,500,1)),
+      (PF_ADJUSTMENT, "crop_v", "Crop V", CROP, (0,500,1)),
+      (PF_TOGGLE, "scratch", "Blend in scratch image", 0)
+    ],
     [],
     plugin_blend,
     menu="<Image>/Linked/Blend",
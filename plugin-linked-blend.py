@@ -2,6 +2,19 @@
 
 from traceback import format_exc
 from gimpfu import *
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import uuid
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 MODE_AVERAGE = 0
 MODE_DARKEN = 1
@@ -9,8 +22,51 @@ MODE_LIGHTEN = 2
 MODE_NORMAL_INVERSE = 3
 MODE_NORMAL_EXTRACT = 4
 MODE_MEDIAN = 5
+MODE_MEDIAN_APPROX = 6
+MODE_SIGMA_CLIP = 7
+MODE_TRIMMED_MEAN = 8
+MODE_PERCENTILE = 9
+
+MODE_NAMES = ['Average','Darken','Lighten','Inverse Normal','Extract Normal','Median','Median (approximate)','Sigma-clipped mean','Trimmed mean','Percentile']
+
+# Histogram bins per channel for the median modes. Exact median needs one bin
+# per value, the approximate median interpolates within wider bins.
+MEDIAN_BINS = {MODE_MEDIAN: 256, MODE_MEDIAN_APPROX: 16}
+# Memory allowed for median histograms. Limits the tile size.
+MEDIAN_MEMORY = 32 << 20
+
+# Modes that keep the value of every layer at each pixel of a tile in a sample
+# buffer. Only the NumPy engine has these modes.
+STACK_MODES = (MODE_SIGMA_CLIP, MODE_TRIMMED_MEAN, MODE_PERCENTILE)
+# Memory allowed for the sample buffer. Limits the tile size.
+STACK_MEMORY = 32 << 20
+# Memory allowed for the rows of every layer overlapping a row of tiles, which
+# are read with one call per layer. Beyond it, each tile is read separately.
+STRIPE_MEMORY = 128 << 20
+# Most passes made by the sigma-clipped mean
+SIGMA_ITERATIONS = 5
+
+# Channel types of each image precision, ignoring whether it is linear or gamma
+PRECISION_TYPES = {100: 'uint8', 200: 'uint16', 300: 'uint32', 500: 'float16', 600: 'float32', 700: 'float64'}
 
-MODE_NAMES = ['Average','Darken','Lighten','Inverse Normal','Extract Normal','Median']
+ENGINE_PYTHON = 0
+ENGINE_NUMPY = 1
+
+ENGINE_NAMES = ['Python (reference)','NumPy']
+
+# Layer weight. Format in the layer name is (w%f)
+WEIGHT_PATTERN = re.compile(r'\(w([^)]*)\)')
+
+# Modes whose totals can be cached and added to. Only the average can have
+# layers removed from its totals.
+CACHE_MODES = (MODE_AVERAGE, MODE_DARKEN, MODE_LIGHTEN)
+# Image parasite describing the cached totals, which are kept in CACHE_DIR
+CACHE_PARASITE = 'blend-linked-cache'
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'gimp-blend-linked')
+# Number of cached blends kept across all images
+CACHE_LIMIT = 4
+# Layout of the cached totals, changed to ignore older caches
+CACHE_VERSION = 2
 
 def get_layers(image, visible=0, linked=0):
   layers = []
@@ -20,13 +76,907 @@ def get_layers(image, visible=0, linked=0):
     layers.append(layer)
   return layers
 
+# Layers in the whole layer tree, top to bottom. Linked layers are searched for
+# the same way as plugin-linked-operations.py does: linked groups are blended
+# as a whole rather than searched, and other groups are searched whether or not
+# they are visible.
+def get_tree_layers(image, visible=0, linked=0, parent=None):
+  layers = []
+  for layer in (image if parent is None else parent).layers:
+    group = pdb.gimp_item_is_group(layer)
+    if linked and not layer.linked:
+      if group: layers.extend(get_tree_layers(image, visible, linked, layer))
+      continue
+    if visible and not layer.visible: continue
+    if group and not linked:
+      layers.extend(get_tree_layers(image, visible, linked, layer))
+    else:
+      layers.append(layer)
+  return layers
+
+
+# Layer weight from the first readable weight in the layer name. None when the
+# name only has weights that cannot be read.
+def get_layer_weight(layer):
+  weight = 1.0
+  for match in WEIGHT_PATTERN.finditer(layer.name):
+    try:
+      return float(match.group(1))
+    except ValueError:
+      weight = None
+  return weight
+
+# Weight of each layer in the order they are blended, resolved before any
+# pixels are read. Returns (layer_no, layer, weight) for each layer with a
+# positive weight. Unreadable weights are reported and treated as 1.
+def get_weight_table(layers):
+  weights = []
+  unreadable = []
+  for layer_no, layer in enumerate(reversed(layers)):
+    weight = get_layer_weight(layer)
+    if weight is None:
+      unreadable.append(layer.name)
+      weight = 1.0
+    if weight > 0.0:
+      weights.append((layer_no, layer, weight))
+  if unreadable:
+    pdb.gimp_message("Blend: Unreadable weight in layer names, using (w1):\n" + "\n".join(unreadable))
+  return weights
+
+# Crop and fade weights along one axis of a layer of n pixels. start and end
+# are set for edges that lie inside the new layer, which are cropped and faded
+# to prevent artifacts. A weight of 0 crops the pixel.
+def edge_ramp(n, start, end, crop, blend):
+  ramp = [1.0]*n
+  for i in xrange(0, n):
+    if start and i < crop + blend:
+      ramp[i] = 0.0 if i < crop else 1.0*(i - crop + 1)/(blend + 1)
+    if end and i >= n - crop - blend:
+      a = 0.0 if i >= n - crop else 1.0*(n - i - crop)/(blend + 1)
+      if a < ramp[i]: ramp[i] = a
+  return ramp
+
+
+# Reference implementation. Blends one pixel at a time in python.
+# With use_masks, layer masks weight each pixel of their layer.
+def blend_python(image, weights, layer_name, new_x, new_y, new_w, new_h, mode, edge_crop_h, edge_crop_v, edge_blend_h, edge_blend_v, use_masks=0):
+  pt = [0.0]*4*new_w*new_h # Total of pixel values
+  pc = [0.0, 0.0, 0.0, 1.0]*new_w*new_h # Count of layers applying to each pixel
+
+  # For tracking progress
+  layers_total = len(weights)
+
+  # Iterate each layer, adding their pixel values to the above totals
+  for layer_index, (layer_no, layer, weight) in enumerate(weights):
+    pdb.gimp_progress_set_text("Blend: Process layer (%d/%d) (w=%.3f)" % (layer_index + 1, layers_total, weight))
+
+    # Copy layer data into variables for faster access
+    lx, ly = layer.offsets
+    # Position relative to created layer
+    lx -= new_x 
+    ly -= new_y
+    lw = layer.width
+    lh = layer.height
+    la = layer.opacity / 100.0
+    lha = layer.has_alpha
+
+    # Crop and/or fade edges to prevent artifacts
+    edge_x = edge_ramp(lw, lx > 0, lx + lw < new_w, edge_crop_h, edge_blend_h)
+    edge_y = edge_ramp(lh, ly > 0, ly + lh < new_h, edge_crop_v, edge_blend_v)
+
+    # Read pixel data for the whole layer at once
+    pr = layer.get_pixel_rgn(0, 0, lw, lh)
+    bpp = pr.bpp
+    pixels = bytearray(pr[:,:])
+    mask = None
+    if use_masks and layer.mask is not None:
+      mask = bytearray(layer.mask.get_pixel_rgn(0, 0, lw, lh)[:,:])
+    
+    for y in xrange(0, lh):
+      ay = edge_y[y]
+      if ay <= 0.0: continue
+      gimp.progress_update((layer_index + 1.0 * y / lh) / (layers_total + 1))
+
+      py = ly + y # Position in new layer
+      row = y*lw*bpp
+      for x in xrange(0, lw):
+        px = lx + x # Position in new layer
+        az = edge_x[x]
+        if az <= 0.0: continue
+        if ay < az: az = ay
+
+        p = pixels[row + x*bpp:row + (x+1)*bpp]  # Pixel value [R, G, B, A]
+        a = p[-1] if lha else 255.0 # Apply pixel alpha
+        a *= la*az*weight
+        if mask is not None: a *= mask[y*lw + x] / 255.0
+        if a <= 0.0: continue
+        af = a/255.0
+        n = (px + py*new_w)*4 # Byte offset for this pixel's first channel in new layer
+
+        # No blending applied to the first layer
+        if layer_no == 0:
+          if mode == MODE_MEDIAN:
+            for c in p[:3]:
+              pt[n] = bytearray((c,))
+              n += 1
+          else:
+            for c in p[:3]:
+              pt[n] = c*af
+              pc[n] = af
+              n += 1
+          pt[n] = a
+
+        ### BLEND
+        elif mode == MODE_AVERAGE:
+          for c in p[:3]:
+            pt[n] += c*af
+            pc[n] += af
+            n += 1
+          if a > pt[n]: pt[n] = a
+
+        ### MEDIAN
+        elif mode == MODE_MEDIAN:
+          for c in p[:3]:
+            if pt[n] == 0.0:
+              pt[n] = bytearray((c,))
+            else:
+              pt[n].append(c)
+            n += 1
+          if a > pt[n]: pt[n] = a
+
+        ### DARKEN
+        elif mode == MODE_DARKEN:
+          for c in p[:3]:
+            if pc[n] <= 0.0:
+              pt[n] = c
+              pc[n] = 1.0
+            else:
+              if c < pt[n]/pc[n]:
+                pt[n] = c*pc[n]
+            n += 1
+          if a > pt[n]: pt[n] = a
+
+        ### LIGHTEN
+        elif mode == MODE_LIGHTEN:
+          for c in p[:3]:
+            if pc[n] <= 0.0:
+              pt[n] = c
+              pc[n] = 1.0
+            else:
+              if c > pt[n]/pc[n]:
+                pt[n] = c*pc[n]
+            n += 1
+          if a > pt[n]: pt[n] = a
+
+        ### INVERSE NORMAL
+        elif mode == MODE_NORMAL_INVERSE:
+          if pt[n+3] > 0.0:
+            if af >= 1.0: continue
+            na = 1.0 - (1.0 - (pt[n+3]/255.0))/af
+            if na > 0.0:
+              for c in p[:3]:
+                # Add weighted pixel value and layer count
+                pt[n] = (pt[n] - c*af) / (1.0 - af) / na
+                pc[n] = 1.0
+                n += 1
+            else:
+              n += 3
+            #  Set pixel alpha to highest opacity encountered for that pixel
+            pt[n] = na*255.0
+
+        ### EXTRACT OVERLAY
+        elif mode == MODE_NORMAL_EXTRACT:
+          if pt[n+3] > 0.0:
+            mc = list(gimp.get_foreground()[:3])
+            mm = None
+            d = 0
+            for i in xrange(0, 3):
+              c = pt[n]
+              pt[n] = mc[i]
+              if abs(mc[i] - c) > d:
+                d = abs(mc[i] - c)
+                mm = 255.0*(p[i] - c)/(mc[i] - c)
+              n += 1
+            #  Set pixel alpha to highest opacity encountered for that pixel
+            if mm is None:
+              pt[n] - 0.0
+            else:
+              pt[n] = mm
+  
+  # Import pixel data to the new layer
+  newlayer = gimp.Layer(image, layer_name, new_w, new_h, RGBA_IMAGE, 100, LAYER_MODE_NORMAL)
+  pr = newlayer.get_pixel_rgn(0, 0, new_w, new_h, True)
+
+  pdb.gimp_progress_set_text("Blend: Create layer")
+  if mode == MODE_MEDIAN:
+    for n in xrange(0, len(pt)):
+      p = pt[n]
+      if type(p) is bytearray:
+        p = list(p)
+        p.sort()
+        i = len(p)
+        if i % 2:
+          pt[n] = p[i // 2]
+        else:
+          i //= 2
+          pt[n] = (p[i] + p[i-1] + 1) // 2
+        pc[n] = 1.0
+    
+  xmax = new_w*4
+  pixels = bytearray(len(pt))
+  for n in xrange(0, len(pt)):
+    if pc[n] > 0.0:
+      p = int(pt[n] / pc[n] + 0.5)
+      if p > 255: p = 255
+      if p < 0: p = 0
+      pixels[n] = p
+    if n % xmax == 0:
+      gimp.progress_update((layers_total + 1.0 * n / len(pt)) / (layers_total + 1.0))
+  # Write all rows at once
+  pr[:,:] = bytes(pixels)
+  return newlayer
+
+
+# Blend one layer into the totals. pt and pc are views of the totals covering
+# the layer, c is the layer's colour channels and a its weighted alpha.
+def blend_array(pt, pc, mode, c, a, first, fg, counts):
+  m = a > 0.0
+  m3 = m[..., None]
+  af = a / 255.0
+  af3 = af[..., None]
+  ptc = pt[..., :3]
+  pcc = pc[..., :3]
+  pta = pt[..., 3]
+
+  # No blending applied to the first layer
+  if first and mode not in MEDIAN_BINS:
+    ptc[...] = numpy.where(m3, c*af3, ptc)
+    pcc[...] = numpy.where(m3, af3, pcc)
+    pta[...] = numpy.where(m, a, pta)
+    return
+
+  ### BLEND
+  if mode == MODE_AVERAGE:
+    ptc[...] = numpy.where(m3, ptc + c*af3, ptc)
+    pcc[...] = numpy.where(m3, pcc + af3, pcc)
+
+  ### MEDIAN
+  elif mode in MEDIAN_BINS:
+    # Count each value in its bin of the pixel's histogram
+    bins = MEDIAN_BINS[mode]
+    y, x, i = numpy.nonzero(numpy.broadcast_to(m3, c.shape))
+    counts[numpy.clip(c[y, x, i] // (256 // bins), 0, bins - 1).astype(int), y, x, i] += 1
+    if first:
+      pta[...] = numpy.where(m, a, pta)
+      return
+
+  ### DARKEN / LIGHTEN
+  elif mode == MODE_DARKEN or mode == MODE_LIGHTEN:
+    empty = m3 & (pcc <= 0.0)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      if mode == MODE_DARKEN:
+        replace = m3 & ~empty & (c < ptc/pcc)
+      else:
+        replace = m3 & ~empty & (c > ptc/pcc)
+    ptc[...] = numpy.where(empty, c, numpy.where(replace, c*pcc, ptc))
+    pcc[...] = numpy.where(empty, 1.0, pcc)
+
+  ### INVERSE NORMAL
+  elif mode == MODE_NORMAL_INVERSE:
+    m &= (pta > 0.0) & (af < 1.0)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      na = 1.0 - (1.0 - (pta/255.0))/af
+      mn = (m & (na > 0.0))[..., None]
+      ptc[...] = numpy.where(mn, (ptc - c*af3) / (1.0 - af3) / na[..., None], ptc)
+    pcc[...] = numpy.where(mn, 1.0, pcc)
+    #  Set pixel alpha to highest opacity encountered for that pixel
+    pta[...] = numpy.where(m, na*255.0, pta)
+    return
+
+  ### EXTRACT OVERLAY
+  elif mode == MODE_NORMAL_EXTRACT:
+    m &= pta > 0.0
+    mm = numpy.zeros(m.shape)
+    found = numpy.zeros(m.shape, bool)
+    d = numpy.zeros(m.shape)
+    for i in xrange(0, 3):
+      ci = ptc[..., i].copy()
+      ptc[..., i] = numpy.where(m, fg[i], ci)
+      diff = abs(fg[i] - ci)
+      larger = diff > d
+      with numpy.errstate(divide='ignore', invalid='ignore'):
+        mm = numpy.where(larger, 255.0*(c[..., i] - ci)/(fg[i] - ci), mm)
+      d = numpy.where(larger, diff, d)
+      found |= larger
+    pta[...] = numpy.where(m & found, mm, pta)
+    return
+
+  #  Set pixel alpha to highest opacity encountered for that pixel
+  pta[...] = numpy.where(m & (a > pta), a, pta)
+
+# Median of the values counted in each pixel's histogram. With one bin per
+# 8-bit value the result is exact, otherwise it is interpolated within the bin.
+def median_counts(counts, exact):
+  bins = counts.shape[0]
+  width = 256 // bins
+  numpy.add.accumulate(counts, 0, out=counts)
+  total = counts[-1]
+  i = total // 2
+  if width == 1 and exact:
+    # Bin of the middle value is the number of bins below it
+    hi = (counts <= i).sum(0)
+    lo = (counts <= numpy.maximum(i, 1) - 1).sum(0)
+    median = numpy.where(total % 2, hi, (hi + lo + 1) // 2)
+  else:
+    median = median_value(counts, i, width)
+    even = total % 2 == 0
+    median[even] = (median[even] + median_value(counts, numpy.maximum(i, 1) - 1, width)[even]) / 2.0
+  return median, total > 0
+
+# Pixel format of a pixel region with the given number of channels, as
+# (channel type, scale to 0-255, linear light). Plug-ins are given 8-bit gamma
+# pixels unless GIMP delivers the image precision, which is only used when the
+# bytes per pixel match it. Linear light is only converted to when the pixels
+# are not linear.
+def pixel_format(image, linear, pr, channels):
+  precision = pdb.gimp_image_get_precision(image)
+  dtype = numpy.dtype(PRECISION_TYPES.get(precision // 100 * 100, 'uint8'))
+  if pr.bpp != channels * dtype.itemsize:
+    dtype = numpy.dtype(numpy.uint8)
+    precision = 150
+  if dtype.kind == 'f':
+    scale = 255.0
+  else:
+    scale = 255.0 / numpy.iinfo(dtype).max
+  return dtype, scale, bool(linear) and precision % 100 != 0
+
+def srgb_to_linear(c):
+  c = c / 255.0
+  return numpy.where(c <= 0.04045, c / 12.92, ((numpy.maximum(c, 0.04045) + 0.055) / 1.055) ** 2.4) * 255.0
+
+def linear_to_srgb(c):
+  c = c / 255.0
+  return numpy.where(c <= 0.0031308, c * 12.92, 1.055 * numpy.maximum(c, 0.0031308) ** (1 / 2.4) - 0.055) * 255.0
+
+# Value of the i'th sample, interpolated within the bin containing it. Counts
+# are cumulative.
+def median_value(counts, i, width):
+  bins = counts.shape[0]
+  b = numpy.minimum((counts <= i).sum(0), bins - 1)
+  above = numpy.take_along_axis(counts, b[None], 0)[0].astype(float)
+  below = numpy.where(b > 0, numpy.take_along_axis(counts, numpy.maximum(b - 1, 0)[None], 0)[0], 0)
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    return (b + (i + 0.5 - below) / (above - below)) * width - 0.5
+
+# Robust statistic of the samples of each pixel, per channel. samples holds
+# the colour of each layer and weights its weighted alpha, 0 where the layer
+# does not cover the pixel. stats is (sigma, trim %, percentile).
+# Returns the values and where any layer covers the pixel.
+def stack_result(samples, weights, mode, stats):
+  sigma, trim, percentile = stats
+  w = weights[..., None]
+  found = weights.sum(0) > 0.0
+
+  ### SIGMA-CLIPPED MEAN
+  if mode == MODE_SIGMA_CLIP:
+    # Repeatedly drop samples further than sigma deviations from the mean
+    keep = numpy.broadcast_to(w > 0.0, samples.shape)
+    for i in xrange(SIGMA_ITERATIONS):
+      kw = numpy.where(keep, w, 0.0)
+      with numpy.errstate(divide='ignore', invalid='ignore'):
+        mean = (kw*samples).sum(0) / kw.sum(0)
+        std = numpy.sqrt((kw*(samples - mean)**2).sum(0) / kw.sum(0))
+        clipped = keep & (abs(samples - mean) <= numpy.maximum(sigma*std, 1e-3))
+      # Never drop every sample of a pixel
+      clipped |= keep & ~clipped.any(0)
+      if (clipped == keep).all(): break
+      keep = clipped
+    kw = numpy.where(keep, w, 0.0)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      return (kw*samples).sum(0) / kw.sum(0), found
+
+  # Sort the samples of each channel, uncovered samples last
+  order = numpy.argsort(numpy.where(w > 0.0, samples, numpy.inf), 0)
+  values = numpy.take_along_axis(samples, order, 0)
+  w = numpy.take_along_axis(numpy.broadcast_to(w, samples.shape), order, 0)
+  cum = numpy.cumsum(w, 0)
+  total = cum[-1]
+
+  ### TRIMMED MEAN
+  if mode == MODE_TRIMMED_MEAN:
+    # Weight of each sample between the trimmed ends
+    lo = total * min(max(trim, 0.0), 49.0) / 100.0
+    kw = numpy.maximum(numpy.minimum(cum, total - lo) - numpy.maximum(cum - w, lo), 0.0)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+      return (kw*values).sum(0) / kw.sum(0), found
+
+  ### PERCENTILE
+  # First sample reaching the percentile of the total weight
+  i = (cum < total * min(max(percentile, 0.0), 100.0) / 100.0).sum(0)
+  i = numpy.clip(i, 0, numpy.maximum((w > 0.0).sum(0) - 1, 0))
+  return numpy.take_along_axis(values, i[None], 0)[0], found
+
+# Final pixel values from the totals, in the pixel format of the image.
+# hdr keeps floating point colours brighter than white.
+def blend_result(pt, pc, fmt, hdr=True):
+  dtype, scale, linear = fmt
+  with numpy.errstate(divide='ignore', invalid='ignore'):
+    p = numpy.where(pc > 0.0, pt/pc, 0.0)
+  if linear:
+    p[..., :3] = linear_to_srgb(p[..., :3])
+  if dtype.kind == 'f':
+    p = numpy.maximum(p / scale, 0.0)
+    if hdr:
+      p[..., 3] = numpy.minimum(p[..., 3], 1.0)
+    else:
+      p = numpy.minimum(p, 1.0)
+    return p.astype(dtype)
+  p = numpy.trunc(p / scale + 0.5)
+  return numpy.clip(p, 0, numpy.iinfo(dtype).max).astype(dtype)
+
+# Read the part of a layer that overlaps a tile of the new layer. Returns the
+# colour channels, weighted alpha and the view of the tile they apply to, or
+# None when the layer does not overlap the tile.
+def read_source(source, tx, ty, tw, th, fmt, exact):
+  layer_no, lx, ly, lw, lh, la, lha, weight, ax, ay, pr, mpr = source
+  dtype, scale, linear = fmt
+  # Overlapping rect in layer coordinates
+  x0 = max(tx - lx, 0)
+  y0 = max(ty - ly, 0)
+  x1 = min(tx + tw - lx, lw)
+  y1 = min(ty + th - ly, lh)
+  if x0 >= x1 or y0 >= y1: return None
+
+  # Read pixel data. Stripes and worker processes hold arrays instead of pixel regions.
+  if isinstance(pr, numpy.ndarray):
+    pixels = pr[y0:y1, x0:x1]
+  else:
+    pixels = numpy.frombuffer(pr[x0:x1, y0:y1], dtype).reshape(y1 - y0, x1 - x0, -1)
+  if not exact:
+    pixels = pixels * scale
+    if linear:
+      pixels[..., :3] = srgb_to_linear(pixels[..., :3])
+
+  # Crop and/or fade edges to prevent artifacts
+  a = la * numpy.minimum(ay[y0:y1, None], ax[None, x0:x1]) * weight
+  if lha:
+    a = pixels[..., -1] * a
+  else:
+    a = 255.0 * a
+  # Layer mask weights
+  if mpr is not None:
+    if isinstance(mpr, numpy.ndarray):
+      mask = mpr[y0:y1, x0:x1]
+    else:
+      mask = numpy.frombuffer(mpr[x0:x1, y0:y1], dtype).reshape(y1 - y0, x1 - x0)
+    a = a * ((mask if exact else mask * scale) / 255.0)
+
+  view = (slice(ly + y0 - ty, ly + y1 - ty), slice(lx + x0 - tx, lx + x1 - tx))
+  return pixels[..., :3], a, view
+
+# Read the rows of each layer that overlap rows sy to sy + sh of the new layer,
+# with one read per layer. Returns the sources with the rows as arrays in place
+# of the pixel regions, so tiles of the stripe are read as views.
+def read_stripe(sources, sy, sh, dtype):
+  stripe = []
+  for layer_no, lx, ly, lw, lh, la, lha, weight, ax, ay, pr, mpr in sources:
+    y0 = max(sy - ly, 0)
+    y1 = min(sy + sh - ly, lh)
+    if y0 >= y1: continue
+    pixels = numpy.frombuffer(pr[0:lw, y0:y1], dtype).reshape(y1 - y0, lw, -1)
+    mask = None
+    if mpr is not None:
+      mask = numpy.frombuffer(mpr[0:lw, y0:y1], dtype).reshape(y1 - y0, lw)
+    stripe.append((layer_no, lx, ly + y0, lw, y1 - y0, la, lha, weight, ax, ay[y0:y1], pixels, mask))
+  return stripe
+
+# Bytes of the rows of the layers overlapping rows rows of the new layer
+def stripe_size(sources, rows):
+  size = 0
+  for layer_no, lx, ly, lw, lh, la, lha, weight, ax, ay, pr, mpr in sources:
+    size += lw * (pr.bpp + (mpr.bpp if mpr is not None else 0)) * min(lh, rows)
+  return size
+
+# Blend the new layer a row of tiles at a time, writing to its pixel region pr.
+# blend(source_sets, tx, ty, tw, th) returns a tile, given the sets of sources
+# with their rows read as stripes when they fit in STRIPE_MEMORY. Otherwise the
+# sources are passed on, so that each tile reads only the overlapping part of
+# each layer, and tiles are written one at a time. text is the progress text,
+# given the rows.
+def blend_tiles(pr, source_sets, new_w, new_h, tile_w, tile_h, fmt, blend, text):
+  striped = stripe_size([source for sources in source_sets for source in sources], tile_h) <= STRIPE_MEMORY
+  for ty in xrange(0, new_h, tile_h):
+    th = min(tile_h, new_h - ty)
+    pdb.gimp_progress_set_text(text % (ty + 1, ty + th, new_h))
+    if striped:
+      stripes = [read_stripe(sources, ty, th, fmt[0]) for sources in source_sets]
+      result = numpy.empty((th, new_w, 4), fmt[0])
+    for tx in xrange(0, new_w, tile_w):
+      tw = min(tile_w, new_w - tx)
+      if striped:
+        result[:, tx:tx + tw] = blend(stripes, tx, ty, tw, th)
+      else:
+        pr[tx:tx + tw, ty:ty + th] = blend(source_sets, tx, ty, tw, th).tobytes()
+    # Import pixel data to the new layer
+    if striped:
+      pr[0:new_w, ty:ty + th] = result.tobytes()
+    gimp.progress_update(1.0 * (ty + th) / new_h)
+
+# 8-bit values are blended as they are, matching blend_python
+def is_exact(fmt):
+  return fmt[0] == numpy.uint8 and not fmt[2]
+
+# Blend the part of each layer that overlaps one tile of the new layer.
+# Returns the final pixel values for the tile.
+def blend_tile(sources, mode, tx, ty, tw, th, fg, fmt, stats=None):
+  exact = is_exact(fmt)
+  pt = numpy.zeros((th, tw, 4)) # Total of pixel values
+  pc = numpy.zeros((th, tw, 4)) # Count of layers applying to each pixel
+  pc[..., 3] = 1.0
+  if mode in MEDIAN_BINS:
+    counts = numpy.zeros((MEDIAN_BINS[mode], th, tw, 3), numpy.uint16)
+  if mode in STACK_MODES:
+    return blend_stack_tile(sources, mode, tx, ty, tw, th, fmt, stats, pt, pc)
+
+  for source in sources:
+    read = read_source(source, tx, ty, tw, th, fmt, exact)
+    if read is None: continue
+    c, a, view = read
+    blend_array(pt[view], pc[view], mode, c, a, source[0] == 0, fg,
+      counts[(slice(None),) + view] if mode in MEDIAN_BINS else None)
+
+  if mode in MEDIAN_BINS:
+    median, found = median_counts(counts, exact)
+    pt[..., :3] = numpy.where(found, median, pt[..., :3])
+    pc[..., :3] = numpy.where(found, 1.0, pc[..., :3])
+  # Separating layers can give extreme values that are not meaningful colours
+  return blend_result(pt, pc, fmt, mode not in (MODE_NORMAL_INVERSE, MODE_NORMAL_EXTRACT))
+
+# Blend one tile with a robust statistic. The samples of every layer covering
+# the tile are gathered into one buffer of a sample per layer per pixel.
+def blend_stack_tile(sources, mode, tx, ty, tw, th, fmt, stats, pt, pc):
+  exact = is_exact(fmt)
+  samples = numpy.zeros((len(sources), th, tw, 3), numpy.float32)
+  weights = numpy.zeros((len(sources), th, tw), numpy.float32)
+  n = 0
+  for source in sources:
+    read = read_source(source, tx, ty, tw, th, fmt, exact)
+    if read is None: continue
+    c, a, view = read
+    samples[(n,) + view] = c
+    weights[(n,) + view] = a / 255.0
+    #  Set pixel alpha to highest opacity encountered for that pixel
+    pt[view][..., 3] = numpy.maximum(pt[view][..., 3], a)
+    n += 1
+  if n == 0: return blend_result(pt, pc, fmt)
+
+  value, found = stack_result(samples[:n], weights[:n], mode, stats)
+  pt[..., :3] = numpy.where(found[..., None], value, 0.0)
+  pc[..., :3] = numpy.where(found[..., None], 1.0, 0.0)
+  return blend_result(pt, pc, fmt)
+
+# Raised when cached totals cannot be updated and must be recalculated
+class CacheMiss(Exception):
+  pass
+
+# Count the layers sharing the highest alpha of each pixel, so that alpha can
+# be recalculated when a layer is removed
+def count_alpha(pm, pta, a):
+  m = a > 0.0
+  pm[...] = numpy.where(m & (a > pta), 1, numpy.where(m & (a == pta), pm + 1, pm))
+
+# Remove a layer added by blend_array from the totals. The totals are floats,
+# so they can round differently to blending the remaining layers afresh.
+def unblend_array(pt, pc, pm, mode, c, a):
+  m = a > 0.0
+  top = m & (a >= pt[..., 3])
+  pm[top] -= 1
+  # The highest alpha is unknown when no other layer shares it
+  if mode != MODE_AVERAGE or (pm[top] == 0).any():
+    raise CacheMiss()
+  m3 = m[..., None]
+  af3 = (a / 255.0)[..., None]
+  pt[..., :3] -= numpy.where(m3, c*af3, 0.0)
+  pc[..., :3] -= numpy.where(m3, af3, 0.0)
+
+# Blend one tile, updating the cached totals. Only added and removed layers are
+# read unless the cache is fresh.
+def blend_cached_tile(cache, added, removed, mode, tx, ty, tw, th, fg, fmt, fresh):
+  exact = is_exact(fmt)
+  tile = (slice(ty, ty + th), slice(tx, tx + tw))
+  if fresh:
+    pt = numpy.zeros((th, tw, 4))
+    pc = numpy.zeros((th, tw, 4))
+    pc[..., 3] = 1.0
+    pm = numpy.zeros((th, tw), numpy.uint16)
+  else:
+    pt = numpy.array(cache['pt'][tile])
+    pc = numpy.empty((th, tw, 4))
+    pc[..., :3] = cache['pc'][tile][..., None]
+    pc[..., 3] = 1.0
+    pm = numpy.array(cache['pm'][tile])
+
+  for source in removed:
+    read = read_source(source, tx, ty, tw, th, fmt, exact)
+    if read is None: continue
+    c, a, view = read
+    unblend_array(pt[view], pc[view], pm[view], mode, c, a)
+  for source in added:
+    read = read_source(source, tx, ty, tw, th, fmt, exact)
+    if read is None: continue
+    c, a, view = read
+    count_alpha(pm[view], pt[view][..., 3], a)
+    blend_array(pt[view], pc[view], mode, c, a, fresh and source[0] == 0, fg, None)
+
+  cache['pt'][tile] = pt
+  cache['pc'][tile] = pc[..., 0]
+  cache['pm'][tile] = pm
+  return blend_result(pt, pc, fmt)
+
+# Identifies the contribution of a layer to the blend, including its content
+def source_key(source):
+  layer_no, lx, ly, lw, lh, la, lha, weight, ax, ay, pr, mpr = source
+  digest = hashlib.sha1(pr[0:lw, 0:lh])
+  if mpr is not None:
+    digest.update(mpr[0:lw, 0:lh])
+  return '%s %d %d %d %d %r %r %d' % (digest.hexdigest(), lx, ly, lw, lh, la, weight, lha)
+
+# Cache description of the image if it was made with the same settings
+def load_cache(image, settings):
+  parasite = image.parasite_find(CACHE_PARASITE)
+  if parasite is None: return None
+  try:
+    meta = json.loads(parasite.data)
+  except ValueError:
+    return None
+  if meta['settings'] != settings: return None
+  if not os.path.isdir(meta['path']): return None
+  return meta
+
+# Directory for the cached totals of an image. Removes the least recently used
+# caches of other images beyond CACHE_LIMIT.
+def cache_path(image):
+  parasite = image.parasite_find(CACHE_PARASITE)
+  path = None
+  if parasite is not None:
+    try:
+      path = json.loads(parasite.data)['path']
+    except (ValueError, KeyError):
+      pass
+  if path is None:
+    path = os.path.join(CACHE_DIR, uuid.uuid4().hex)
+  if not os.path.isdir(path):
+    os.makedirs(path)
+  os.utime(path, None)
+  others = [os.path.join(CACHE_DIR, name) for name in os.listdir(CACHE_DIR)]
+  others.sort(key=os.path.getmtime, reverse=True)
+  for other in others[CACHE_LIMIT:]:
+    shutil.rmtree(other, True)
+  return path
+
+# The counts of the cached modes are the same for each colour channel, and
+# alpha is not counted, so only one count is kept for each pixel
+def cache_arrays(path, shape, file_mode):
+  open_memmap = numpy.lib.format.open_memmap
+  return {
+    'pt': open_memmap(os.path.join(path, 'pt.npy'), file_mode, numpy.float64, shape + (4,)),
+    'pc': open_memmap(os.path.join(path, 'pc.npy'), file_mode, numpy.float64, shape),
+    'pm': open_memmap(os.path.join(path, 'pm.npy'), file_mode, numpy.uint16, shape)}
+
+def save_cache(image, path, settings, keys):
+  meta = {'path': path, 'settings': settings, 'layers': keys}
+  image.attach_new_parasite(CACHE_PARASITE, 0, json.dumps(meta))
+
+# Layer properties and edge weights, gathered once for all tiles
+def layer_source(layer_no, layer, weight, new_x, new_y, new_w, new_h, edge_crop_h, edge_crop_v, edge_blend_h, edge_blend_v, use_masks=0):
+  lx, ly = layer.offsets
+  # Position relative to created layer
+  lx -= new_x
+  ly -= new_y
+  lw = layer.width
+  lh = layer.height
+  ax = numpy.array(edge_ramp(lw, lx > 0, lx + lw < new_w, edge_crop_h, edge_blend_h))
+  ay = numpy.array(edge_ramp(lh, ly > 0, ly + lh < new_h, edge_crop_v, edge_blend_v))
+  pr = layer.get_pixel_rgn(0, 0, lw, lh)
+  mpr = None
+  if use_masks and layer.mask is not None:
+    mpr = layer.mask.get_pixel_rgn(0, 0, lw, lh)
+  return (layer_no, lx, ly, lw, lh, layer.opacity / 100.0, layer.has_alpha, weight, ax, ay, pr, mpr)
+
+# Shared memory of a worker process, set by band_init
+shared = {}
+
+def band_init(pixels, result):
+  shared['pixels'] = numpy.frombuffer(pixels, numpy.uint8)
+  shared['result'] = numpy.frombuffer(result, numpy.uint8)
+
+# Array in shared memory, given as (offset, shape) by blend_parallel
+def shared_array(marker, dtype):
+  if marker is None: return None
+  offset, shape = marker
+  size = numpy.prod(shape) * numpy.dtype(dtype).itemsize
+  return shared['pixels'][offset:offset + size].view(dtype).reshape(shape)
+
+# Blend one band of rows in a worker process. The layer rows overlapping the
+# band are read from shared memory. The result is written to shared memory
+# relative to row sy.
+def blend_band(args):
+  stripe, mode, fg, fmt, new_w, sy, by, bh, tile_w, stats = args
+  sources = []
+  for layer_no, lx, ly, lw, lh, la, lha, weight, ax, ay, pr, mpr in stripe:
+    sources.append((layer_no, lx, ly, lw, lh, la, lha, weight, ax, ay, shared_array(pr, fmt[0]), shared_array(mpr, fmt[0])))
+  result = shared['result'].view(fmt[0]).reshape(-1, new_w, 4)
+  for tx in xrange(0, new_w, tile_w):
+    tw = min(tile_w, new_w - tx)
+    result[by - sy:by - sy + bh, tx:tx + tw] = blend_tile(sources, mode, tx, by, tw, bh, fg, fmt, stats)
+  return bh
+
+# Blend bands of rows in parallel. Layers are read a stripe of rows at a time
+# into shared memory, one band per process, as only the main process can
+# access GIMP. Bands are made shorter than tiles when a stripe would not fit in
+# STRIPE_MEMORY.
+def blend_parallel(sources, mode, fg, fmt, new_w, new_h, tile_w, tile_h, processes, pr, stats):
+  band_h = min(tile_h, (new_h + processes - 1) // processes)
+  row_size = stripe_size(sources, 1)
+  if row_size:
+    band_h = max(min(band_h, STRIPE_MEMORY // (row_size * processes)), 1)
+  stripe_h = band_h * processes
+  size = stripe_size(sources, stripe_h)
+  pixels = multiprocessing.RawArray('B', max(size, 1))
+  result = multiprocessing.RawArray('B', new_w * stripe_h * 4 * fmt[0].itemsize)
+  pool = multiprocessing.Pool(processes, band_init, (pixels, result))
+  pixels = numpy.frombuffer(pixels, numpy.uint8)
+  result = numpy.frombuffer(result, numpy.uint8)
+
+  # Copy an array to shared memory, returning its (offset, shape)
+  def share(array, offset):
+    if array is None: return None, offset
+    data = array.view(numpy.uint8).ravel()
+    pixels[offset:offset + data.size] = data
+    return (offset, array.shape), offset + data.size
+
+  try:
+    done = 0
+    for sy in xrange(0, new_h, stripe_h):
+      sh = min(stripe_h, new_h - sy)
+      pdb.gimp_progress_set_text("Blend: Process rows (%d-%d/%d)" % (sy + 1, sy + sh, new_h))
+
+      # Copy the rows of each layer that overlap the stripe
+      stripe = []
+      offset = 0
+      for layer_no, lx, ly, lw, lh, la, lha, weight, ax, ay, lpixels, mask in read_stripe(sources, sy, sh, fmt[0]):
+        pixels_marker, offset = share(lpixels, offset)
+        mask_marker, offset = share(mask, offset)
+        stripe.append((layer_no, lx, ly, lw, lh, la, lha, weight, ax, ay, pixels_marker, mask_marker))
+
+      bands = [(stripe, mode, fg, fmt, new_w, sy, by, min(band_h, sy + sh - by), tile_w, stats) for by in xrange(sy, sy + sh, band_h)]
+      for bh in pool.imap_unordered(blend_band, bands):
+        done += bh
+        gimp.progress_update(1.0 * done / new_h)
+      # Import pixel data to the new layer
+      pr[0:new_w, sy:sy + sh] = result[:new_w*sh*4*fmt[0].itemsize].tobytes()
+    pool.close()
+  finally:
+    pool.terminate()
+    pool.join()
+
+# Blends layers using numpy arrays. Gives the same result as blend_python.
+# The new layer is processed in tiles of tile_size pixels. The rows of each
+# layer overlapping a row of tiles are read at once while they fit in
+# STRIPE_MEMORY, and otherwise each tile reads only the overlapping part of
+# each layer, so memory use does not depend on the size of the new layer.
+# A tile_size of 0 processes the new layer as a single tile.
+# With more than one process, bands of rows are blended in parallel.
+# Layers are read and written at the precision GIMP delivers them in, optionally
+# blending in linear light.
+# With use_masks, layer masks weight each pixel of their layer.
+# The robust statistic modes use stats, which is (sigma, trim %, percentile).
+# With use_cache, the totals of the average, darken and lighten modes are kept
+# between runs, so that only layers that were linked or unlinked since the last
+# run need to be blended. Cached blends use a single process.
+def blend_numpy(image, weights, layer_name, new_x, new_y, new_w, new_h, mode, edge_crop_h, edge_crop_v, edge_blend_h, edge_blend_v, tile_size=0, processes=1, linear=0, use_cache=0, use_masks=0, stats=None):
+  newlayer = gimp.Layer(image, layer_name, new_w, new_h, RGBA_IMAGE, 100, LAYER_MODE_NORMAL)
+  pr = newlayer.get_pixel_rgn(0, 0, new_w, new_h, True)
+  fmt = pixel_format(image, linear, pr, 4)
+  fg = list(gimp.get_foreground()[:3])
+  if fmt[2]:
+    fg = list(srgb_to_linear(numpy.array(fg, float)))
+  edges = (edge_crop_h, edge_crop_v, edge_blend_h, edge_blend_v)
+
+  sources = []
+  ids = []
+  for layer_no, layer, weight in weights:
+    sources.append(layer_source(layer_no, layer, weight, new_x, new_y, new_w, new_h, *edges, use_masks=use_masks))
+    ids.append(str(layer.ID))
+
+  if use_cache and mode in CACHE_MODES:
+    blend_cached(image, newlayer, sources, ids, mode, new_x, new_y, new_w, new_h, edges, tile_size, fg, fmt, use_masks)
+    return newlayer
+
+  tile_w = int(tile_size) or new_w
+  tile_h = int(tile_size) or new_h
+  if mode in MEDIAN_BINS:
+    # Each pixel of a tile holds a histogram for each channel
+    limit = max(int((MEDIAN_MEMORY // (MEDIAN_BINS[mode] * 3 * 2)) ** 0.5) // 64 * 64, 64)
+    tile_w = min(tile_w, limit)
+    tile_h = min(tile_h, limit)
+  if mode in STACK_MODES:
+    # Each pixel of a tile holds a colour and weight for each layer
+    limit = max(int((STACK_MEMORY // (max(len(sources), 1) * 4 * 4)) ** 0.5) // 16 * 16, 16)
+    tile_w = min(tile_w, limit)
+    tile_h = min(tile_h, limit)
+
+  if processes > 1:
+    blend_parallel(sources, mode, fg, fmt, new_w, new_h, tile_w, tile_h, int(processes), pr, stats)
+    return newlayer
+
+  def blend(source_sets, tx, ty, tw, th):
+    return blend_tile(source_sets[0], mode, tx, ty, tw, th, fg, fmt, stats)
+  blend_tiles(pr, [sources], new_w, new_h, tile_w, tile_h, fmt, blend, "Blend: Process rows (%d-%d/%d)")
+  return newlayer
+
+
+# Blend using the totals cached by the previous run, when the cache was made
+# with the same settings and none of its layers have changed
+def blend_cached(image, newlayer, sources, ids, mode, new_x, new_y, new_w, new_h, edges, tile_size, fg, fmt, use_masks):
+  pdb.gimp_progress_set_text("Blend: Check cache")
+  keys = [source_key(source) for source in sources]
+  settings = [CACHE_VERSION, new_x, new_y, new_w, new_h, mode] + list(edges) + [str(fmt[0]), fmt[2], use_masks]
+  meta = load_cache(image, settings)
+  added = sources
+  removed = []
+  if meta is not None:
+    cached = meta['layers']
+    # Changed layers cannot be removed from the totals
+    if any(cached.get(i, key) != key for i, key in zip(ids, keys)):
+      meta = None
+    else:
+      added = [source for i, source in zip(ids, sources) if i not in cached]
+    # Unlinked layers are removed using their current content
+    for i in (cached if meta is not None else ()):
+      if i in ids: continue
+      try:
+        layer = gimp.Item.from_id(int(i))
+        source = layer_source(-1, layer, get_layer_weight(layer) or 1.0, new_x, new_y, new_w, new_h, *edges, use_masks=use_masks)
+      except:
+        source = None
+      if source is None or source_key(source) != cached[i]:
+        meta = None
+        break
+      removed.append(source)
+
+  path = cache_path(image)
+  if meta is not None:
+    try:
+      blend_cache_tiles(newlayer, path, added, removed, mode, new_w, new_h, tile_size, fg, fmt, False)
+    except CacheMiss:
+      meta = None
+  if meta is None:
+    blend_cache_tiles(newlayer, path, sources, [], mode, new_w, new_h, tile_size, fg, fmt, True)
+  save_cache(image, path, settings, dict(zip(ids, keys)))
+
+def blend_cache_tiles(newlayer, path, added, removed, mode, new_w, new_h, tile_size, fg, fmt, fresh):
+  cache = cache_arrays(path, (new_h, new_w), 'w+' if fresh else 'r+')
+  pr = newlayer.get_pixel_rgn(0, 0, new_w, new_h, True)
+  tile_w = int(tile_size) or new_w
+  tile_h = int(tile_size) or new_h
+  def blend(source_sets, tx, ty, tw, th):
+    return blend_cached_tile(cache, source_sets[0], source_sets[1], mode, tx, ty, tw, th, fg, fmt, fresh)
+  text = "Blend: Process rows (%%d-%%d/%%d) (%d added, %d removed)" % (len(added), len(removed))
+  blend_tiles(pr, [added, removed], new_w, new_h, tile_w, tile_h, fmt, blend, text)
+  for array in cache.values():
+    array.flush()
+
 
 # Main function
-def plugin_main(image, drawable, visible_only, linked_only, blend_mode, edge_crop_h, edge_crop_v, edge_blend_h, edge_blend_v):
+def plugin_main(image, drawable, visible_only, linked_only, blend_mode, edge_crop_h, edge_crop_v, edge_blend_h, edge_blend_v, engine=ENGINE_NUMPY, tile_size=512, processes=1, linear=0, use_cache=0, use_masks=0, sigma=3.0, trim=10, percentile=50, recursive=0):
   try:
-    # Get all linked layers within the specified image or layer group
+    # Get all linked layers within the specified image or layer group, or in
+    # nested groups
     parent = pdb.gimp_item_get_parent(drawable)
-    if parent is None:
+    if recursive:
+      layers = get_tree_layers(image, visible_only, linked_only)
+    elif parent is None:
       layers = get_layers(image, visible_only, linked_only)
     else:
       layers = get_layers(parent, visible_only, linked_only)
@@ -35,9 +985,6 @@ def plugin_main(image, drawable, visible_only, linked_only, blend_mode, edge_cro
     if len(layers) <= 0: return
 
     gimp.progress_init("Blend: Init")
-    # Precalculated constant
-    edge_total_h = edge_crop_h + edge_blend_h
-    edge_total_v = edge_crop_h + edge_blend_v
 
     # New layer name combining the first and last layer names
     layer_name = layers[-1].name.partition('.')[0] + "-" + layers[0].name.partition('.')[0]
@@ -59,214 +1006,23 @@ def plugin_main(image, drawable, visible_only, linked_only, blend_mode, edge_cro
     new_w -= new_x
     new_h -= new_y
 
-    pt = [0.0]*4*new_w*new_h # Total of pixel values
-    pc = [0.0, 0.0, 0.0, 1.0]*new_w*new_h # Count of layers applying to each pixel
-
-    # For tracking progress
-    layer_no = -1
-    layers_total = len(layers)
-    mode = blend_mode
+    # Layers that contribute to the blend, with their weights
+    weights = get_weight_table(layers)
+    if not weights: return
 
-    # Iterate each layer, adding their pixel values to the above totals
-    for layer in reversed(layers):
-      layer_no += 1
-      # Set layer weight. Format in the layer name is (w%f) 
-      i = 0
-      weight = 1.0
-      while 1:
-        i = layer.name.find('(w', i)
-        if i < 0: break
-        i += 2
-        j = layer.name.find(')', i)
-        if j < 0: continue
-        try:
-          weight = float(layer.name[i:j])
-          break
-        except:
-          pass
-      if weight <= 0.0: continue
-
-      pdb.gimp_progress_set_text("Blend: Process layer (%d/%d) (w=%.3f)" % (layer_no + 1, layers_total, weight))
-
-      # Copy layer data into variables for faster access
-      lx, ly = layer.offsets
-      # Position relative to created layer
-      lx -= new_x 
-      ly -= new_y
-      lw = layer.width
-      lh = layer.height
-      la = layer.opacity / 100.0
-      lha = layer.has_alpha
-
-      # Read pixel data
-      pr = layer.get_pixel_rgn(0, 0, lw, lh)
-      bpp = pr.bpp
-      
-      for y in xrange(0, lh):
-        pixels = bytearray(pr[:,y])
-        gimp.progress_update((layer_no + 1.0 * y / lh) / (layers_total + 1))
-
-        # Crop and/or fade edges to prevent artifacts
-        py = ly + y # Position in new layer
-        if y < edge_total_v and ly > 0:
-          if y < edge_crop_v: continue
-          ay = 1.0*(y - edge_crop_v + 1)/(edge_blend_v + 1)
-        else:
-          ay = 1.0
-        if y >= lh - edge_total_v and ly + lh < new_h:
-          if y >= lh - edge_crop_v: continue
-          az = 1.0*(lh - y - edge_crop_v)/(edge_blend_v + 1)
-          if az < ay: ay = az
-        for x in xrange(0, lw):
-          px = lx + x # Position in new layer
-          az = ay
-          if x < edge_total_h and lx > 0:
-            if x < edge_crop_h:
-              continue
-            else:
-              ax = 1.0*(x - edge_crop_h + 1)/(edge_blend_h + 1)
-              if ax < az: az = ax
-          if x >= lw - edge_total_h and lx + lw < new_w:
-            if x >= lw - edge_crop_h: continue
-            ax = 1.0*(lw - x - edge_crop_h)/(edge_blend_h + 1)
-            if ax < az: az = ax
-
-          p = pixels[x*bpp:(x+1)*bpp]  # Pixel value [R, G, B, A]
-          a = p[-1] if lha else 255.0 # Apply pixel alpha
-          a *= la*az*weight
-          if a <= 0.0: continue
-          af = a/255.0
-          n = (px + py*new_w)*4 # Byte offset for this pixel's first channel in new layer
-
-          # No blending applied to the first layer
-          if layer_no == 0:
-            if mode == MODE_MEDIAN:
-              for c in p[:3]:
-                pt[n] = bytearray((c,))
-                n += 1
-            else:
-              for c in p[:3]:
-                pt[n] = c*af
-                pc[n] = af
-                n += 1
-            pt[n] = a
+    # Only the NumPy engine has the robust statistic modes
+    if blend_mode in STACK_MODES and numpy is None:
+      pdb.gimp_message("Blend: %s needs numpy" % MODE_NAMES[blend_mode])
+      return
 
-          ### BLEND
-          elif mode == MODE_AVERAGE:
-            for c in p[:3]:
-              pt[n] += c*af
-              pc[n] += af
-              n += 1
-            if a > pt[n]: pt[n] = a
-
-          ### MEDIAN
-          elif mode == MODE_MEDIAN:
-            for c in p[:3]:
-              if pt[n] == 0.0:
-                pt[n] = bytearray((c,))
-              else:
-                pt[n].append(c)
-              n += 1
-            if a > pt[n]: pt[n] = a
-
-          ### DARKEN
-          elif mode == MODE_DARKEN:
-            for c in p[:3]:
-              if pc[n] <= 0.0:
-                pt[n] = c
-                pc[n] = 1.0
-              else:
-                if c < pt[n]/pc[n]:
-                  pt[n] = c*pc[n]
-              n += 1
-            if a > pt[n]: pt[n] = a
+    # Fall back to the python implementation when numpy is not installed
+    if (engine == ENGINE_NUMPY or blend_mode in STACK_MODES) and numpy is not None:
+      newlayer = blend_numpy(image, weights, layer_name, new_x, new_y, new_w, new_h, blend_mode, edge_crop_h, edge_crop_v, edge_blend_h, edge_blend_v, tile_size, processes, linear, use_cache, use_masks, (sigma, trim, percentile))
+    else:
+      # The reference implementation only has an exact median
+      if blend_mode == MODE_MEDIAN_APPROX: blend_mode = MODE_MEDIAN
+      newlayer = blend_python(image, weights, layer_name, new_x, new_y, new_w, new_h, blend_mode, edge_crop_h, edge_crop_v, edge_blend_h, edge_blend_v, use_masks)
 
-          ### LIGHTEN
-          elif mode == MODE_LIGHTEN:
-            for c in p[:3]:
-              if pc[n] <= 0.0:
-                pt[n] = c
-                pc[n] = 1.0
-              else:
-                if c > pt[n]/pc[n]:
-                  pt[n] = c*pc[n]
-              n += 1
-            if a > pt[n]: pt[n] = a
-
-          ### INVERSE NORMAL
-          elif mode == MODE_NORMAL_INVERSE:
-            if pt[n+3] > 0.0:
-              if af >= 1.0: continue
-              na = 1.0 - (1.0 - (pt[n+3]/255.0))/af
-              if na > 0.0:
-                for c in p[:3]:
-                  # Add weighted pixel value and layer count
-                  pt[n] = (pt[n] - c*af) / (1.0 - af) / na
-                  pc[n] = 1.0
-                  n += 1
-              else:
-                n += 3
-              #  Set pixel alpha to highest opacity encountered for that pixel
-              pt[n] = na*255.0
-
-          ### EXTRACT OVERLAY
-          elif mode == MODE_NORMAL_EXTRACT:
-            if pt[n+3] > 0.0:
-              mc = list(gimp.get_foreground()[:3])
-              mm = None
-              d = 0
-              for i in xrange(0, 3):
-                c = pt[n]
-                pt[n] = mc[i]
-                if abs(mc[i] - c) > d:
-                  d = abs(mc[i] - c)
-                  mm = 255.0*(p[i] - c)/(mc[i] - c)
-                n += 1
-              #  Set pixel alpha to highest opacity encountered for that pixel
-              if mm is None:
-                pt[n] - 0.0
-              else:
-                pt[n] = mm
-    
-    # Import pixel data to the new layer
-    newlayer = gimp.Layer(image, layer_name, new_w, new_h, RGBA_IMAGE, 100, LAYER_MODE_NORMAL)
-    pr = newlayer.get_pixel_rgn(0, 0, new_w, new_h, True)
-
-    pdb.gimp_progress_set_text("Blend: Create layer")
-    if mode == MODE_MEDIAN:
-      for n in xrange(0, len(pt)):
-        p = pt[n]
-        if type(p) is bytearray:
-          p = list(p)
-          p.sort()
-          i = len(p)
-          if i % 2:
-            pt[n] = p[i // 2]
-          else:
-            i //= 2
-            pt[n] = (p[i] + p[i-1] + 1) // 2
-          pc[n] = 1.0
-      
-    xmax = new_w*4
-    pixels = bytearray(new_w*4)
-    x = 0
-    y = 0
-    for n in xrange(0, len(pt)):
-      if pc[n] > 0.0:
-        p = int(pt[n] / pc[n] + 0.5)
-        if p > 255: p = 255
-        if p < 0: p = 0
-        pixels[x] = p
-      else:
-        pixels[x] = 0
-      x += 1
-      if x >= xmax:
-        # Process one row at a time to abate memory errors
-        pr[:,y] = bytes(pixels)
-        x = 0
-        y += 1
-        gimp.progress_update((layers_total + 1.0 * y / new_h) / (layers_total + 1.0))
-    
     newlayer.set_offsets(new_x, new_y)
     pdb.gimp_image_insert_layer(image, newlayer, parent, new_pos)
     gimp.displays_flush()
@@ -293,7 +1049,17 @@ if __name__ == "__main__":
       (PF_ADJUSTMENT, "edge_crop_h", "Crop H", 0, (0,500,1)),
       (PF_ADJUSTMENT, "edge_crop_v", "Crop V", 0, (0,500,1)),
       (PF_ADJUSTMENT, "edge_blend_h", "Blend H", 0, (0,500,1)),
-      (PF_ADJUSTMENT, "edge_blend_v", "Blend V", 0, (0,500,1))
+      (PF_ADJUSTMENT, "edge_blend_v", "Blend V", 0, (0,500,1)),
+      (PF_OPTION, "engine", "Engine", ENGINE_NUMPY, ENGINE_NAMES),
+      (PF_ADJUSTMENT, "tile_size", "Tile size", 512, (0,8192,64)),
+      (PF_ADJUSTMENT, "processes", "Processes (not with Cache totals)", 1, (1,64,1)),
+      (PF_TOGGLE, "linear", "Linear light", 0),
+      (PF_TOGGLE, "use_cache", "Cache totals", 0),
+      (PF_TOGGLE, "use_masks", "Layer masks as weights", 0),
+      (PF_ADJUSTMENT, "sigma", "Sigma (sigma-clipped mean)", 3.0, (0.1,10.0,0.1)),
+      (PF_ADJUSTMENT, "trim", "Trim % (trimmed mean)", 10, (0,49,1)),
+      (PF_ADJUSTMENT, "percentile", "Percentile", 50, (0,100,1)),
+      (PF_TOGGLE, "recursive", "Nested groups", 0)
     ],
     [],
     plugin_main,
@@ -4,13 +4,243 @@ from traceback import format_exc
 from gimpfu import *
 import gtk
 
-def get_layers(image, visible=False, linked=False):
-    layers = []
-    for layer in image.layers:
-        if visible and not layer.visible: continue
-        if linked and not layer.linked: continue
-        layers.append(layer)
-    return layers
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Modes of the active layer that overlay composites directly into the linked
+# layers, and whether each composites in linear light
+OVERLAY_MODES = {LAYER_MODE_NORMAL: True, LAYER_MODE_NORMAL_LEGACY: False}
+
+# Channel types of the image precisions overlay composites directly, ignoring
+# whether they are linear or gamma
+PRECISION_TYPES = {100: 'uint8', 200: 'uint16'}
+
+# Image parasite present when the Linked actions search nested groups, saved
+# with the image
+RECURSIVE_PARASITE = 'linked-recursive'
+RECURSIVE_FLAGS = 1
+
+# Snapshot of the children of an image or layer group, read once per operation.
+# Keeps the layers with their ids and linked/visible flags in stacking order,
+# and a map from id to position that is updated as layers are inserted into or
+# removed from the container, instead of asking the PDB for each layer.
+class LayerIndex(object):
+    def __init__(self, image, parent):
+        self.image = image
+        self.parent = parent
+        self.layers = list((image if parent is None else parent).layers)
+        self.ids = [layer.ID for layer in self.layers]
+        self.linked = [layer.linked for layer in self.layers]
+        self.visible = [layer.visible for layer in self.layers]
+        self.positions = {}
+        self.reindex(0)
+
+    # Renumber the positions of the layers from start down
+    def reindex(self, start):
+        for i in xrange(start, len(self.ids)):
+            self.positions[self.ids[i]] = i
+
+    def __len__(self):
+        return len(self.layers)
+
+    def __contains__(self, layer):
+        return layer is not None and layer.ID in self.positions
+
+    def position(self, layer):
+        return self.positions[layer.ID]
+
+    def get(self, position):
+        if 0 <= position < len(self.layers): return self.layers[position]
+        return None
+
+    def get_layers(self, visible=False, linked=False):
+        return [layer for i, layer in enumerate(self.layers)
+            if (self.visible[i] or not visible) and (self.linked[i] or not linked)]
+
+    def set_linked(self, layer, linked):
+        layer.linked = linked
+        self.linked[self.position(layer)] = linked
+
+    def set_visible(self, layer, visible):
+        layer.visible = visible
+        self.visible[self.position(layer)] = visible
+
+    # Record a layer inserted into the container at position
+    def insert(self, layer, position):
+        self.layers.insert(position, layer)
+        self.ids.insert(position, layer.ID)
+        self.linked.insert(position, layer.linked)
+        self.visible.insert(position, layer.visible)
+        self.reindex(position)
+
+    # Record a layer removed from the container
+    def remove(self, layer):
+        position = self.positions.pop(layer.ID)
+        del self.layers[position], self.ids[position], self.linked[position], self.visible[position]
+        self.reindex(position)
+
+    # Record a layer replaced in place, as by merging down onto it
+    def replace(self, layer, new_layer):
+        position = self.positions.pop(layer.ID)
+        self.layers[position] = new_layer
+        self.ids[position] = new_layer.ID
+        self.linked[position] = new_layer.linked
+        self.visible[position] = new_layer.visible
+        self.positions[new_layer.ID] = position
+
+def is_recursive(image):
+    return image.parasite_find(RECURSIVE_PARASITE) is not None
+
+# Groups holding linked layers in the whole layer tree, with None for the top
+# level. Linked groups are not searched, as their layers are operated on with
+# them. plugin-linked-blend.py searches the tree the same way.
+def find_linked(image, parent=None):
+    found = []
+    for layer in (image if parent is None else parent).layers:
+        if layer.linked:
+            if parent not in found: found.append(parent)
+        elif pdb.gimp_item_is_group(layer):
+            found.extend(find_linked(image, layer))
+    return found
+
+# Linked layers to operate on, as a LayerIndex for each group holding them,
+# each group read once. Only the active layer's group, unless nested groups are
+# searched. The tree is searched again by every action, as GIMP gives no way
+# to tell whether layers have been linked since the last one.
+def get_linked_sets(image, drawable):
+    if not is_recursive(image):
+        index = LayerIndex(image, pdb.gimp_item_get_parent(drawable))
+        return [index] if index.get_layers(linked=True) else []
+    return [LayerIndex(image, parent) for parent in find_linked(image)]
+
+# Move a layer into parent at position. Reordering moves the layer itself, where
+# older versions of GIMP have to replace it with a copy. Returns the moved layer.
+def move_layer(image, layer, parent, position):
+    try:
+        reorder = pdb.gimp_image_reorder_item
+    except AttributeError:
+        new_layer = pdb.gimp_layer_copy(layer, False)
+        new_layer.name = layer.name
+        pdb.gimp_image_remove_layer(image, layer)
+        pdb.gimp_image_insert_layer(image, new_layer, parent, position)
+        return new_layer
+    reorder(image, layer, parent, position)
+    return layer
+
+# Part of a layer within the selection bounds, as x, y, width, height in image
+# coordinates, or None when they do not overlap. bounds is None when nothing is
+# selected, which covers the whole layer.
+def selection_rect(layer, bounds):
+    lx, ly = layer.offsets
+    x1, y1, x2, y2 = lx, ly, lx + layer.width, ly + layer.height
+    if bounds is not None:
+        x1 = max(x1, bounds[0])
+        y1 = max(y1, bounds[1])
+        x2 = min(x2, bounds[2])
+        y2 = min(y2, bounds[3])
+    if x1 >= x2 or y1 >= y2: return None
+    return x1, y1, x2 - x1, y2 - y1
+
+# Copy a rect of a layer into a new layer of the same size, placed over it
+def copy_rect(image, layer, rect):
+    x, y, w, h = rect
+    lx, ly = layer.offsets
+    new_layer = gimp.Layer(image, layer.name + "(float)", w, h, layer.type, layer.opacity, layer.mode)
+    new_layer.set_offsets(x, y)
+    new_layer.visible = layer.visible
+    pr = layer.get_pixel_rgn(x - lx, y - ly, w, h, False, False)
+    new_pr = new_layer.get_pixel_rgn(0, 0, w, h, True, False)
+    new_pr[0:w, 0:h] = pr[x - lx:x - lx + w, y - ly:y - ly + h]
+    new_layer.flush()
+    return new_layer
+
+def srgb_to_linear(values):
+    return numpy.where(values <= 0.04045, values / 12.92, ((values + 0.055) / 1.055) ** 2.4)
+
+def linear_to_srgb(values):
+    return numpy.where(values <= 0.0031308, values * 12.92, 1.055 * values ** (1 / 2.4) - 0.055)
+
+# The active layer, read once and composited with its mode and opacity straight
+# into the part of each linked layer it overlaps, without merging layers
+class Overlay(object):
+    def __init__(self, image, drawable):
+        precision = pdb.gimp_image_get_precision(image)
+        self.image = image
+        self.dtype = numpy.dtype(PRECISION_TYPES[precision // 100 * 100])
+        self.max = numpy.iinfo(self.dtype).max
+        # Convert between the image's encoding and the compositing space
+        self.decode = self.encode = None
+        linear = OVERLAY_MODES[pdb.gimp_layer_get_mode(drawable)]
+        if linear and precision % 100:
+            self.decode, self.encode = srgb_to_linear, linear_to_srgb
+        elif not linear and not precision % 100:
+            self.decode, self.encode = linear_to_srgb, srgb_to_linear
+        self.opacity = pdb.gimp_layer_get_opacity(drawable) / 100.0
+        self.x, self.y = drawable.offsets
+        self.width, self.height = drawable.width, drawable.height
+        self.pixels = self.read(drawable, self.x, self.y, self.width, self.height)
+
+    # Whether the active layer is composited the way apply does, rather than
+    # with a composite space or mode of its own
+    @staticmethod
+    def composites(drawable):
+        return (pdb.gimp_layer_get_mode(drawable) in OVERLAY_MODES
+            and pdb.gimp_layer_get_composite_space(drawable) == LAYER_COLOR_SPACE_AUTO
+            and pdb.gimp_layer_get_composite_mode(drawable) == LAYER_COMPOSITE_AUTO)
+
+    # Whether a layer can be composited into directly, rather than merged.
+    # Plug-ins are given 8-bit pixels unless GIMP delivers the image precision,
+    # and writing those back would lose it, so the bytes per pixel must match.
+    @staticmethod
+    def supports(image, layer):
+        if numpy is None or pdb.gimp_image_base_type(image) == INDEXED: return False
+        if pdb.gimp_item_is_group(layer) or layer.mask is not None: return False
+        dtype = PRECISION_TYPES.get(pdb.gimp_image_get_precision(image) // 100 * 100)
+        return dtype is not None and layer.bpp == (4 if layer.has_alpha else 3) * numpy.dtype(dtype).itemsize
+
+    # Pixels of a rect of a layer in image coordinates, scaled to 0-1 in the
+    # compositing space, with alpha last
+    def read(self, layer, x, y, w, h):
+        lx, ly = layer.offsets
+        pr = layer.get_pixel_rgn(x - lx, y - ly, w, h, False, False)
+        pixels = numpy.frombuffer(pr[x - lx:x - lx + w, y - ly:y - ly + h], self.dtype).reshape(h, w, -1)
+        pixels = pixels.astype(numpy.float32) / self.max
+        if not layer.has_alpha:
+            pixels = numpy.concatenate([pixels, numpy.ones((h, w, 1), numpy.float32)], -1)
+        if self.decode is not None:
+            pixels[..., :-1] = self.decode(pixels[..., :-1])
+        return pixels
+
+    # Composite onto the part of a layer within both the active layer and the
+    # image. The rect is selected so that only it is written back, with undo.
+    def apply(self, layer):
+        lx, ly = layer.offsets
+        x1 = max(self.x, lx, 0)
+        y1 = max(self.y, ly, 0)
+        x2 = min(self.x + self.width, lx + layer.width, self.image.width)
+        y2 = min(self.y + self.height, ly + layer.height, self.image.height)
+        if x1 >= x2 or y1 >= y2: return
+        w, h = x2 - x1, y2 - y1
+
+        overlay = self.pixels[y1 - self.y:y2 - self.y, x1 - self.x:x2 - self.x]
+        backdrop = self.read(layer, x1, y1, w, h)
+        overlay_alpha = overlay[..., -1:] * self.opacity
+        alpha = overlay_alpha + backdrop[..., -1:] * (1.0 - overlay_alpha)
+        ratio = numpy.divide(overlay_alpha, alpha, out=numpy.zeros_like(alpha), where=alpha > 0.0)
+        colour = backdrop[..., :-1] + (overlay[..., :-1] - backdrop[..., :-1]) * ratio
+        if self.encode is not None:
+            colour = self.encode(colour)
+        pixels = numpy.concatenate([colour, alpha], -1) if layer.has_alpha else colour
+        pixels = numpy.clip(pixels * self.max + 0.5, 0, self.max).astype(self.dtype)
+
+        pdb.gimp_image_select_rectangle(self.image, CHANNEL_OP_REPLACE, x1, y1, w, h)
+        pr = layer.get_pixel_rgn(x1 - lx, y1 - ly, w, h, True, True)
+        pr[x1 - lx:x2 - lx, y1 - ly:y2 - ly] = pixels.tobytes()
+        layer.flush()
+        layer.merge_shadow(True)
+        layer.update(x1 - lx, y1 - ly, w, h)
 
 def plugin_copy(image, drawable):
     plugin_cut(image, drawable, delete = False)
@@ -22,39 +252,49 @@ def plugin_erase(image, drawable):
 def plugin_cut(image, drawable, copy = True, delete = True):
     try:
         # Get all visible linked layers in the currently active group
-        parent = pdb.gimp_item_get_parent(drawable)
-        layers = get_layers(image if parent is None else parent, linked=True)
-        if not layers: return
+        indexes = get_linked_sets(image, drawable)
+        if not indexes: return
+        selected, x1, y1, x2, y2 = pdb.gimp_selection_bounds(image)
+        bounds = (x1, y1, x2, y2) if selected else None
         pdb.gimp_image_undo_group_start(image)
 
         # Float the selected area
-        for layer in reversed(layers):
-            # Sanity checks
-            if pdb.gimp_item_get_parent(layer) != parent: continue
-
-            if copy:
-                # Create and insert the float layer
-                new_layer = pdb.gimp_layer_copy(layer, True)
-                new_layer.name = layer.name + "(float)"
-                position = pdb.gimp_image_get_item_position(image, layer)
-                pdb.gimp_image_insert_layer(image, new_layer, parent, position)
-
-                # Crop out the unselected area
-                mask = pdb.gimp_layer_create_mask(new_layer, ADD_MASK_BLACK)
-                pdb.gimp_layer_add_mask(new_layer, mask)
-                pdb.gimp_edit_fill(mask, FILL_WHITE)
-                pdb.gimp_layer_remove_mask(new_layer, MASK_APPLY)
-
-                new_layer.linked = True
-                if layer == drawable:
-                    drawable = new_layer
+        for index in indexes:
+            for layer in reversed(index.get_layers(linked=True)):
+                # Sanity checks
+                if layer not in index: continue
+                # Only the selection bounds are copied or cleared
+                rect = selection_rect(layer, bounds)
+                if rect is None:
+                    index.set_linked(layer, False)
+                    continue
+
+                if copy:
+                    # Create and insert the float layer over the selection bounds
+                    new_layer = copy_rect(image, layer, rect)
+                    position = index.position(layer)
+                    pdb.gimp_image_insert_layer(image, new_layer, index.parent, position)
+                    index.insert(new_layer, position)
+                    if not new_layer.has_alpha:
+                        pdb.gimp_layer_add_alpha(new_layer)
+
+                    # Crop out the unselected area
+                    if selected:
+                        mask = pdb.gimp_layer_create_mask(new_layer, ADD_MASK_BLACK)
+                        pdb.gimp_layer_add_mask(new_layer, mask)
+                        pdb.gimp_edit_fill(mask, FILL_WHITE)
+                        pdb.gimp_layer_remove_mask(new_layer, MASK_APPLY)
+
+                    index.set_linked(new_layer, True)
+                    if layer == drawable:
+                        drawable = new_layer
             
-            # Erase the selected area from the original layer when cutting
-            if delete:
-                pdb.gimp_edit_clear(layer)
+                # Erase the selected area from the original layer when cutting
+                if delete:
+                    pdb.gimp_edit_clear(layer)
             
-            layer.linked = False
-            # If the original layer was selected, select the new layer instead
+                index.set_linked(layer, False)
+                # If the original layer was selected, select the new layer instead
 
         pdb.gimp_image_set_active_layer(image, drawable)    
         pdb.gimp_image_undo_group_end(image)
@@ -73,38 +313,23 @@ def plugin_link(image, drawable, down = True, up = True):
     try:
         # Get all visible linked layers in the currently active group
         parent = pdb.gimp_item_get_parent(drawable)
-        layers = get_layers(image if parent is None else parent)
-        if not layers: return
-
-        affected_layers = []
-        i = 0
-        for layer in layers:
-            if up:
-                affected_layers.append(layer)
-            if layer == drawable:
-                break
-            if layer.linked:
-                affected_layers = []
-            i += 1
+        index = LayerIndex(image, parent)
+        if drawable not in index: return
+
+        # Extend from the active layer to the nearest linked layers
+        i = index.position(drawable)
+        start = end = i
+        if up:
+            while start > 0 and not index.linked[start - 1]:
+                start -= 1
         if down:
-            link = False
-            for layer in layers[i:]:
-                if link:
-                    if layer.linked:
-                        break
-                    affected_layers.append(layer)
-                elif layer == drawable:
-                    if layer not in affected_layers:
-                        affected_layers.append(layer)
-                    link = True
-        if not affected_layers: return
+            while end + 1 < len(index) and not index.linked[end + 1]:
+                end += 1
+        affected_layers = index.layers[start:end + 1]
 
-        # Transfer each layer to the new group
         pdb.gimp_image_undo_group_start(image)
         for layer in affected_layers:
-            # Sanity checks
-            if pdb.gimp_item_get_parent(layer) != parent: continue
-            layer.linked = True
+            index.set_linked(layer, True)
         pdb.gimp_image_undo_group_end(image)
     
     except:
@@ -113,18 +338,17 @@ def plugin_link(image, drawable, down = True, up = True):
 def plugin_set(image, drawable, getfunc, setfunc):
     try:
         # Get all visible linked layers in the currently active group
-        parent = pdb.gimp_item_get_parent(drawable)
-        layers = get_layers(image if parent is None else parent, linked=True)
-        if not layers: return
+        indexes = get_linked_sets(image, drawable)
+        if not indexes: return
 
         value = getfunc(drawable)
             
         pdb.gimp_image_undo_group_start(image)
-        for layer in layers:
-            # Sanity checks
-            if layer == drawable: continue
-            if pdb.gimp_item_get_parent(layer) != parent: continue
-            setfunc(layer, value)
+        for index in indexes:
+            for layer in index.get_layers(linked=True):
+                # Sanity checks
+                if layer == drawable: continue
+                setfunc(layer, value)
         pdb.gimp_image_undo_group_end(image)
     except:
         pdb.gimp_message(format_exc())
@@ -141,25 +365,25 @@ def plugin_group(image, drawable):
     try:
         # Get all visible linked layers in the currently active group
         parent = pdb.gimp_item_get_parent(drawable)
-        layers = get_layers(image if parent is None else parent, linked=True)
+        index = LayerIndex(image, parent)
+        layers = index.get_layers(linked=True)
         if not layers: return
 
         # Create the parent group
         pdb.gimp_image_undo_group_start(image)
         group = pdb.gimp_layer_group_new(image)
         group.name = layers[0].name + " Group"
-        position = pdb.gimp_image_get_item_position(image, layers[0])
+        position = index.position(layers[0])
         pdb.gimp_image_insert_layer(image, group, parent, position)
+        index.insert(group, position)
 
         # Transfer each layer to the new group
         for layer in reversed(layers):
             # Sanity checks
-            if pdb.gimp_item_get_parent(layer) != parent: continue
+            if layer not in index: continue
 
-            new_layer = pdb.gimp_layer_copy(layer, False)
-            new_layer.name = layer.name
-            pdb.gimp_image_remove_layer(image, layer)
-            pdb.gimp_image_insert_layer(image, new_layer, group, 0)
+            index.remove(layer)
+            new_layer = move_layer(image, layer, group, 0)
             if layer == drawable: drawable = new_layer
         
         pdb.gimp_image_set_active_layer(image, drawable)
@@ -178,23 +402,24 @@ def plugin_ungroup(image, drawable):
             parent = pdb.gimp_item_get_parent(drawable)
             if parent is None: return
         grandparent = pdb.gimp_item_get_parent(parent)
-        layers = get_layers(parent, linked=True)
+        index = LayerIndex(image, parent)
+        layers = index.get_layers(linked=True)
         if not layers: return
+        outer = LayerIndex(image, grandparent)
 
-        # Merge the selected layers down.
+        # Move the linked layers above the group, in the same order
         pdb.gimp_image_undo_group_start(image)
         for layer in layers:
             # Sanity checks
-            if pdb.gimp_item_get_parent(layer) != parent: continue
-            new_layer = pdb.gimp_layer_copy(layer, False)
-            new_layer.name = layer.name
-            pdb.gimp_image_remove_layer(image, layer)
-            position = pdb.gimp_image_get_item_position(image, parent)
-            pdb.gimp_image_insert_layer(image, new_layer, grandparent, position)
+            if layer not in index: continue
+            index.remove(layer)
+            position = outer.position(parent)
+            new_layer = move_layer(image, layer, grandparent, position)
+            outer.insert(new_layer, position)
             if layer == drawable: drawable = new_layer
         
         pdb.gimp_image_set_active_layer(image, drawable)
-        if len(parent.layers) == 0:
+        if len(index) == 0:
             pdb.gimp_image_remove_layer(image, parent)
         pdb.gimp_image_undo_group_end(image)
     
@@ -205,33 +430,58 @@ def plugin_ungroup(image, drawable):
 def plugin_overlay(image, drawable):
     try:
         # Get all visible linked layers in the currently active group
-        parent = pdb.gimp_item_get_parent(drawable)
-        parent_layer = image if parent is None else parent
-        layers = get_layers(parent_layer, linked=True)
-        if not layers: return
+        indexes = get_linked_sets(image, drawable)
+        if not indexes: return
         
-        # Merge the selected layers down.
         pdb.gimp_image_undo_group_start(image)
-        for layer in reversed(layers):
-            # Sanity checks
-            if pdb.gimp_item_get_parent(layer) != parent: continue
-            if layer == drawable: continue
-            
-            new_layer = pdb.gimp_layer_copy(drawable, True)
-            new_layer.visible = True
-            layer.visible = True
-            position = pdb.gimp_image_get_item_position(image, layer)
-            if pdb.gimp_image_get_item_position(image, drawable) > position:
-                # Selected layer is background
-                pdb.gimp_image_insert_layer(image, new_layer, parent, position + 1)
-                layer_name = layer.name
-                new_layer = pdb.gimp_image_merge_down(image, layer, EXPAND_AS_NECESSARY)
-                new_layer.name = layer_name
-            else:
-                # Selected layer is foreground
-                pdb.gimp_image_insert_layer(image, new_layer, parent, position)
-                new_layer = pdb.gimp_image_merge_down(image, new_layer, EXPAND_AS_NECESSARY)
-            new_layer.linked = False
+        # Composite directly when the active layer and image allow it. The
+        # selection is replaced while compositing, and restored afterwards.
+        overlay = selection = None
+        if Overlay.composites(drawable) and Overlay.supports(image, drawable):
+            overlay = Overlay(image, drawable)
+            pdb.gimp_context_push()
+            pdb.gimp_context_set_feather(False)
+            if not pdb.gimp_selection_is_empty(image):
+                selection = pdb.gimp_selection_save(image)
+
+        try:
+            for index in indexes:
+                for layer in reversed(index.get_layers(linked=True)):
+                    # Sanity checks
+                    if layer not in index: continue
+                    if layer == drawable: continue
+
+                    index.set_visible(layer, True)
+                    position = index.position(layer)
+                    # Selected layer is background when it is below, in the same group
+                    background = drawable in index and index.position(drawable) > position
+                    if not background and overlay is not None and Overlay.supports(image, layer):
+                        # Selected layer is foreground, composited into the layer
+                        overlay.apply(layer)
+                        index.set_linked(layer, False)
+                        continue
+
+                    # Otherwise merge a copy of the selected layer
+                    new_layer = pdb.gimp_layer_copy(drawable, True)
+                    new_layer.visible = True
+                    if background:
+                        pdb.gimp_image_insert_layer(image, new_layer, index.parent, position + 1)
+                        layer_name = layer.name
+                        merged_layer = pdb.gimp_image_merge_down(image, layer, EXPAND_AS_NECESSARY)
+                        merged_layer.name = layer_name
+                    else:
+                        pdb.gimp_image_insert_layer(image, new_layer, index.parent, position)
+                        merged_layer = pdb.gimp_image_merge_down(image, new_layer, EXPAND_AS_NECESSARY)
+                    merged_layer.linked = False
+                    index.replace(layer, merged_layer)
+        finally:
+            if overlay is not None:
+                if selection is None:
+                    pdb.gimp_selection_none(image)
+                else:
+                    pdb.gimp_image_select_item(image, CHANNEL_OP_REPLACE, selection)
+                    pdb.gimp_image_remove_channel(image, selection)
+                pdb.gimp_context_pop()
 
         pdb.gimp_image_set_active_layer(image, drawable)
         pdb.gimp_image_undo_group_end(image)
@@ -243,29 +493,30 @@ def plugin_overlay(image, drawable):
 def plugin_merge(image, drawable):
     try:
         # Get all visible linked layers in the currently active group
-        parent = pdb.gimp_item_get_parent(drawable)
-        parent_layer = image if parent is None else parent
-        layers = get_layers(parent_layer, linked=True)
-        if not layers: return
+        indexes = get_linked_sets(image, drawable)
+        if not indexes: return
         
         # Merge the selected layers down.
         pdb.gimp_image_undo_group_start(image)
-        for layer in reversed(layers):
-            # Sanity checks
-            if pdb.gimp_item_get_parent(layer) != parent: continue
+        for index in indexes:
+            for layer in reversed(index.get_layers(linked=True)):
+                # Sanity checks
+                if layer not in index: continue
             
-            position = pdb.gimp_image_get_item_position(image, layer) + 1
-            if position >= len(parent_layer.layers): continue
-            second_layer = parent_layer.layers[position]
-            visible = layer.visible or second_layer.visible
-            layer.visible = True
-            second_layer.visible = True
-            new_layer = pdb.gimp_image_merge_down(image, layer, EXPAND_AS_NECESSARY)
-            new_layer.linked = True
-            new_layer.visible = visible
-            # If either of the original layers were selected, select the merged layer
-            if (layer == drawable): drawable = new_layer
-            if (second_layer == drawable): drawable = new_layer
+                position = index.position(layer) + 1
+                second_layer = index.get(position)
+                if second_layer is None: continue
+                visible = index.visible[position - 1] or index.visible[position]
+                layer.visible = True
+                second_layer.visible = True
+                new_layer = pdb.gimp_image_merge_down(image, layer, EXPAND_AS_NECESSARY)
+                new_layer.linked = True
+                new_layer.visible = visible
+                index.remove(layer)
+                index.replace(second_layer, new_layer)
+                # If either of the original layers were selected, select the merged layer
+                if (layer == drawable): drawable = new_layer
+                if (second_layer == drawable): drawable = new_layer
 
         pdb.gimp_image_set_active_layer(image, drawable)
         pdb.gimp_image_undo_group_end(image)
@@ -277,25 +528,36 @@ def plugin_merge(image, drawable):
 def plugin_delete(image, drawable):
     try:
         # Get all visible linked layers in the currently active group
-        parent = pdb.gimp_item_get_parent(drawable)
-        parent_layer = image if parent is None else parent
-        layers = get_layers(parent_layer, linked=True)
-        if not layers: return
+        indexes = get_linked_sets(image, drawable)
+        if not indexes: return
         
         # Merge the selected layers down.
         pdb.gimp_image_undo_group_start(image)
-        for layer in reversed(layers):
-            # Sanity checks
-            if pdb.gimp_item_get_parent(layer) != parent: continue
+        for index in indexes:
+            for layer in reversed(index.get_layers(linked=True)):
+                # Sanity checks
+                if layer not in index: continue
             
-            position = pdb.gimp_image_get_item_position(image, layer) + 1
-            pdb.gimp_image_remove_layer(image, layer)
+                pdb.gimp_image_remove_layer(image, layer)
+                index.remove(layer)
 
         pdb.gimp_image_undo_group_end(image)
     
     except:
         pdb.gimp_message(format_exc())
 
+# Toggle whether the Linked actions search nested groups for linked layers
+def plugin_recursive(image, drawable):
+    try:
+        if is_recursive(image):
+            image.parasite_detach(RECURSIVE_PARASITE)
+            pdb.gimp_message("Linked: Only linked layers in the active layer's group are used")
+        else:
+            image.attach_new_parasite(RECURSIVE_PARASITE, RECURSIVE_FLAGS, '1')
+            pdb.gimp_message("Linked: Linked layers in nested groups are used")
+    except:
+        pdb.gimp_message(format_exc())
+
 if __name__ == "__main__":
   
     gettext.install("gimp20-python", gimp.locale_directory, unicode=True)
@@ -535,5 +797,23 @@ if __name__ == "__main__":
         plugin_set_opacity,
         menu="<Image>/Li_nked/_Match",
         )
+
+    register(
+        "python_fu_linked_recursive",
+        "Toggle whether the Linked actions use linked layers in nested groups, or only in the active layer's group.",
+        "",
+        "Gavin Ward",
+        "Gavin Ward",
+        "2020",
+        "_Nested Groups",
+        "*",
+        [
+            (PF_IMAGE, "image", "Input image", None),
+            (PF_DRAWABLE, "drawable", "Input drawable", None)
+        ],
+        [],
+        plugin_recursive,
+        menu="<Image>/Li_nked",
+        )
       
     main()
@@ -1,63 +1,243 @@
-# Expands the selection to fill all grid tiles with at least one pixel selected
+# Expands the selection to fill all grid tiles with at least one pixel selected,
+# or optionally a percentage of each tile
 
 from array import array
 from traceback import format_exc
 from gimpfu import *
+import csv
+import json
 
-def plugin_main(image, drawable, border=0):
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+# Whether a tile is selected, given the number of selected pixels inside its
+# border and the area inside its border. coverage is a percentage of the area.
+def is_covered(count, area, coverage):
+  return (count > 0) & (count * 100.0 >= coverage * area)
+
+# Reference implementation. Counts the selected pixels of each tile one row at
+# a time.
+def select_tiles_python(selection, iw, ih, sx1, sy1, sw, sh, gw, gh, border, coverage=0, level=0):
+  unselected = bytes(bytearray(xrange(0, level + 1)))
+  bh = gh
+  for by in xrange(sy1, sy1+sh, gh):
+    pdb.gimp_progress_update(float(by-sy1) / sh)
+    if ih - by < bh: bh = ih - by
+    bw = gw
+    for bx in xrange(sx1, sx1+sw, gw):
+      if iw - bx < bw: bw = iw - bx
+      n = by * iw + bx
+      nn = n + border * (iw + 1)
+      area = (bw - border * 2) * (bh - border * 2)
+      count = 0
+      for y in xrange(0, bh - border * 2):
+        count += len(selection[nn:nn+bw - border * 2].translate(None, unselected))
+        if is_covered(count, area, coverage):
+          nn = n
+          for y in xrange(0, bh):
+            selection[nn:nn+bw] = b'\xFF'*bw
+            nn += iw
+          break
+        nn += iw
+      else:
+        nn = n
+        for y in xrange(0, bh):
+          selection[nn:nn+bw] = b'\x00'*bw
+          nn += iw
+
+# Start and end of the part of each tile inside its border along one axis.
+# Tiles are cut short at the edge of the image.
+def inner_bounds(start, size, spacing, limit, border):
+  starts = numpy.arange(start, start + size, spacing)
+  ends = numpy.minimum(starts + spacing, limit)
+  inner0 = numpy.clip(starts + border, 0, limit)
+  inner1 = numpy.clip(ends - border, inner0, limit)
+  return inner0, inner1
+
+# Counts the selected pixels of each tile in O(1) from an integral of the
+# selected pixels inside the border of each row of tiles
+def select_tiles_numpy(selection, iw, ih, sx1, sy1, sw, sh, gw, gh, border, coverage=0, level=0):
+  pixels = numpy.frombuffer(selection, numpy.uint8).reshape(ih, iw)
+  x0, x1 = inner_bounds(sx1, sw, gw, iw, border)
+  y0, y1 = inner_bounds(sy1, sh, gh, ih, border)
+  # Tile of each column of the rect, to expand the tiles back to pixels
+  bx0 = max(sx1, 0)
+  bx1 = min(sx1 + sw, iw)
+  columns = (numpy.arange(bx0, bx1) - sx1) // gw
+
+  for row in xrange(0, len(y0)):
+    pdb.gimp_progress_update(float(row) / len(y0))
+    by0 = max(sy1 + row * gh, 0)
+    by1 = min(sy1 + (row + 1) * gh, ih)
+    if by0 >= by1: continue
+
+    integral = numpy.zeros(iw + 1, numpy.int64)
+    numpy.cumsum((pixels[y0[row]:y1[row]] > level).sum(0), out=integral[1:])
+    count = integral[x1] - integral[x0]
+    tiles = is_covered(count, (x1 - x0) * (y1[row] - y0[row]), coverage)
+
+    # Fill or clear each tile
+    pixels[by0:by1, bx0:bx1] = numpy.where(tiles[columns], 255, 0)[None, :]
+
+# Rect of a tile table entry as (x, y, w, h), from [x, y, w, h] or an object
+# with x, y, w and h, optionally under "frame". Values such as 12.0 are
+# truncated to whole pixels.
+def table_rect(item):
+  if isinstance(item, dict):
+    item = item.get('frame', item)
+    return tuple(int(float(item[key])) for key in ('x', 'y', 'w', 'h'))
+  return tuple(int(float(value)) for value in item[:4])
+
+# Rects listed in a tile table. JSON tables hold a list of rects, or an object
+# of them such as the frames of a sprite sheet. CSV tables have x, y, w and h
+# columns, or a rect in the first four columns when there is no header.
+def load_tile_table(path):
+  if path.lower().endswith('.json'):
+    with open(path) as f:
+      items = json.load(f)
+    if isinstance(items, dict):
+      items = items.get('frames', items)
+    if isinstance(items, dict):
+      items = items.values()
+    rects = [table_rect(item) for item in items]
+  else:
+    with open(path, 'rb') as f:
+      rows = [row for row in csv.reader(f) if row]
+    columns = [0, 1, 2, 3]
+    try:
+      float(rows[0][0])
+    except (IndexError, ValueError):
+      header = [name.strip().lower() for name in rows[0]]
+      columns = [header.index(name) for name in ('x', 'y', 'w', 'h')]
+      del(rows[0])
+    rects = [table_rect([row[i] for i in columns]) for row in rows]
+  return [rect for rect in rects if rect[2] > 0 and rect[3] > 0]
+
+# Buckets of a square grid holding the rects that overlap each bucket
+def build_tile_index(rects, size):
+  index = {}
+  for i, (x, y, w, h) in enumerate(rects):
+    for by in xrange(y // size, (y + h - 1) // size + 1):
+      for bx in xrange(x // size, (x + w - 1) // size + 1):
+        index.setdefault((bx, by), []).append(i)
+  return index
+
+# Selects the rects of a tile table with a selected pixel, or the coverage
+# percentage selected, inside their border. Only the buckets of the index that
+# hold selected pixels are searched, and only the selection bounds and the
+# rects found are read. Returns the rect that was changed and its pixels.
+def select_tiles_table(image, rects, border, coverage=0, level=0):
+  iw = image.width
+  ih = image.height
+  size = max(sorted(max(w, h) for x, y, w, h in rects)[len(rects) // 2], 1) if rects else 1
+  index = build_tile_index(rects, size)
+
+  # Buckets holding selected pixels
+  bounds, x1, y1, x2, y2 = pdb.gimp_selection_bounds(image)
+  pixels = numpy.frombuffer(image.selection.get_pixel_rgn(x1, y1, x2 - x1, y2 - y1, 0, 0)[:,:], numpy.uint8)
+  bx0 = x1 // size * size
+  by0 = y1 // size * size
+  bw = (x2 - bx0 + size - 1) // size * size
+  bh = (y2 - by0 + size - 1) // size * size
+  buckets = numpy.zeros((bh, bw), bool)
+  buckets[y1 - by0:y2 - by0, x1 - bx0:x2 - bx0] = pixels.reshape(y2 - y1, x2 - x1) != 0
+  buckets = buckets.reshape(bh // size, size, bw // size, size).any(3).any(1)
+  found = set()
+  for by, bx in zip(*numpy.nonzero(buckets)):
+    found.update(index.get((bx + bx0 // size, by + by0 // size), ()))
+
+  # Read the selection bounds and the rects found
+  x0, y0, x3, y3 = x1, y1, x2, y2
+  for i in found:
+    x, y, w, h = rects[i]
+    x0 = min(x0, max(x, 0))
+    y0 = min(y0, max(y, 0))
+    x3 = max(x3, min(x + w, iw))
+    y3 = max(y3, min(y + h, ih))
+  rw = x3 - x0
+  rh = y3 - y0
+  selection = bytearray(image.selection.get_pixel_rgn(x0, y0, rw, rh, 0, 0)[:,:])
+  pixels = numpy.frombuffer(selection, numpy.uint8).reshape(rh, rw)
+
+  # Clear the rects that are not covered before filling the others, so that
+  # overlapping rects stay selected
+  covered = []
+  for i in sorted(found):
+    x, y, w, h = rects[i]
+    # Part of the rect in the image, and inside its border
+    view = (slice(max(y, 0) - y0, min(y + h, ih) - y0), slice(max(x, 0) - x0, min(x + w, iw) - x0))
+    ix0 = max(x + border, 0)
+    iy0 = max(y + border, 0)
+    ix1 = max(min(x + w, iw) - border, ix0)
+    iy1 = max(min(y + h, ih) - border, iy0)
+    count = (pixels[iy0 - y0:iy1 - y0, ix0 - x0:ix1 - x0] > level).sum()
+    if is_covered(count, (ix1 - ix0) * (iy1 - iy0), coverage):
+      covered.append(view)
+    else:
+      pixels[view] = 0
+  for view in covered:
+    pixels[view] = 255
+  return x0, y0, rw, rh, selection
+
+# Selects the tiles of the image grid. Returns the rect that was changed and
+# its pixels.
+def select_grid(image, border, coverage=0, level=0):
+  gx, gy = pdb.gimp_image_grid_get_offset(image)
+  gw, gh = pdb.gimp_image_grid_get_spacing(image)
+  gx = int(gx)
+  gy = int(gy)
+  gw = int(gw)
+  gh = int(gh)
+  bounds, x1, y1, x2, y2 = pdb.gimp_selection_bounds(image)
+
+  sx1 = int((x1 - gx) // gw * gw + gx)
+  sy1 = int((y1 - gy) // gh * gh + gy)
+  sw = (x2 - sx1 + gw - 1) // gw * gw
+  sh = (y2 - sy1 + gh - 1) // gh * gh
+
+  # Only the grid-aligned rect of the selection within the image is read
+  # and written. Nothing outside it is selected.
+  x0 = max(sx1, 0)
+  y0 = max(sy1, 0)
+  rw = min(sx1 + sw, image.width) - x0
+  rh = min(sy1 + sh, image.height) - y0
+  selection = bytearray(image.selection.get_pixel_rgn(x0, y0, rw, rh, 0, 0)[:,:])
+  # Fall back to the python implementation when numpy is not installed
+  if numpy is not None:
+    select_tiles_numpy(selection, rw, rh, sx1 - x0, sy1 - y0, sw, sh, gw, gh, border, coverage, level)
+  else:
+    select_tiles_python(selection, rw, rh, sx1 - x0, sy1 - y0, sw, sh, gw, gh, border, coverage, level)
+  return x0, y0, rw, rh, selection
+
+def plugin_main(image, drawable, border=0, coverage=0, level=0, tile_table=""):
   try:
     if pdb.gimp_selection_is_empty(image):
       return
+    if tile_table and numpy is None:
+      pdb.gimp_message("Select grid: Tile tables need numpy")
+      return
+    if tile_table:
+      try:
+        rects = load_tile_table(tile_table)
+      except (EnvironmentError, csv.Error, ValueError, OverflowError, KeyError, IndexError, TypeError) as e:
+        pdb.gimp_message("Select grid: Cannot read tile table %s (%s)" % (tile_table, e))
+        return
 
-    
     pdb.gimp_image_undo_group_start(image)
-    gx, gy = pdb.gimp_image_grid_get_offset(image)
-    gw, gh = pdb.gimp_image_grid_get_spacing(image)
-    gx = int(gx)
-    gy = int(gy)
-    gw = int(gw)
-    gh = int(gh)
-    selection = image.selection
-    bounds, x1, y1, x2, y2 = pdb.gimp_selection_bounds(image)
-
-    sx1 = int((x1 - gx) // gw * gw + gx)
-    sy1 = int((y1 - gy) // gh * gh + gy)
-    sw = (x2 - sx1 + gw - 1) // gw * gw
-    sh = (y2 - sy1 + gh - 1) // gh * gh
-
-    iw = image.width
-    ih = image.height
-    selection = bytearray(image.selection.get_pixel_rgn(0, 0, iw, ih, 0, 0)[:,:])
-    bh = gh
     gimp.progress_init("Select grid")
     pdb.gimp_progress_set_text("Select grid: Processing")
-    for by in xrange(sy1, sy1+sh, gh):
-      pdb.gimp_progress_update(float(by-sy1) / sh)
-      if ih - by < bh: bh = ih - by
-      bw = gw
-      for bx in xrange(sx1, sx1+sw, gw):
-        if iw - bx < bw: bw = iw - bx
-        n = by * iw + bx
-        nn = n + border * (iw + 1)
-        for y in xrange(0, bh - border * 2):
-          if selection[nn:nn+bw - border * 2].count(b'\x00') < bw - border * 2:
-            nn = n
-            for y in xrange(0, bh):
-              selection[nn:nn+bw] = b'\xFF'*bw
-              nn += iw
-            break
-          nn += iw
-        else:
-          nn = n
-          for y in xrange(0, bh):
-            selection[nn:nn+bw] = b'\x00'*bw
-            nn += iw
+    if tile_table:
+      x0, y0, rw, rh, selection = select_tiles_table(image, rects, int(border), coverage, int(level))
+    else:
+      x0, y0, rw, rh, selection = select_grid(image, int(border), coverage, int(level))
     pdb.gimp_progress_set_text("Select grid: Applying")
     pdb.gimp_progress_update(1.0)
-    pdb.gimp_selection_none(image)
-    selection_w = image.selection.get_pixel_rgn(0, 0, image.width, image.height, 1, 1)
+    selection_w = image.selection.get_pixel_rgn(x0, y0, rw, rh, 1, 1)
     selection_w[:,:] = bytes(selection)
     image.selection.merge_shadow()
+    image.selection.update(x0, y0, rw, rh)
     gimp.displays_flush()
     pdb.gimp_image_undo_group_end(image)
     
@@ -77,7 +257,14 @@ if __name__ == "__main__":
     "2017",
     "Selection to Grid",
     "*",
-    [(PF_IMAGE, "image", "Input image", None), (PF_DRAWABLE, "drawable", "Input drawable", None)],
+    [
+      (PF_IMAGE, "image", "Input image", None),
+      (PF_DRAWABLE, "drawable", "Input drawable", None),
+      (PF_ADJUSTMENT, "border", "Border", 0, (0,500,1)),
+      (PF_ADJUSTMENT, "coverage", "Coverage %", 0, (0,100,1)),
+      (PF_ADJUSTMENT, "level", "Selected above", 0, (0,254,1)),
+      (PF_FILE, "tile_table", "Tile table (JSON/CSV, instead of the grid)", "")
+    ],
     [],
     plugin_main,
     menu="<Image>/Select",